@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Runs the tasks of the .sby files in parallel. A task that passed is recorded
+# in .cache together with a hash of its .sby file and sources and is skipped
+# until one of them changes.
+import argparse
+import concurrent.futures
+import hashlib
+import os
+import re
+import subprocess
+import sys
+
+def sby_sections(path):
+  sections = {}
+  section = None
+  with open(path) as file:
+    for line in file:
+      line = line.strip()
+      if line.startswith('[') and line.endswith(']'):
+        section = sections.setdefault(line[1:-1], [])
+      elif line != '' and not line.startswith('#') and section is not None:
+        section.append(line)
+  return sections
+
+def sby_tasks(path):
+  return [line.split()[0].rstrip(':') for line in sby_sections(path).get('tasks', [])]
+
+# The macros that a task's read commands define.
+def task_defines(path, task):
+  defines = set()
+  for line in sby_sections(path).get('script', []):
+    if line.startswith(task + ':'):
+      defines |= set(re.findall(r'-D(\w+)', line))
+  return defines
+
+# The groups of properties a task doesn't read (`ifdef FV_... blocks whose macro
+# it doesn't define under FV_GROUP) are left out of its hash, so that changing
+# properties only invalidates the tasks that assert or assume them.
+def task_hash(path, task):
+  defines = task_defines(path, task)
+  def unused_group(match):
+    return '' if 'FV_GROUP' in defines and match.group(1) not in defines else match.group(0)
+  h = hashlib.sha256()
+  h.update(task.encode())
+  with open(path, 'rb') as file:
+    h.update(file.read())
+  for src in sby_sections(path).get('files', []):
+    with open(os.path.join(os.path.dirname(path), src.split()[-1])) as file:
+      h.update(re.sub(r'`ifdef (FV_\w+)\n.*?`endif\n', unused_group, file.read(), flags=re.S).encode())
+  return h.hexdigest()
+
+def cache_file(path, task):
+  name = os.path.splitext(os.path.basename(path))[0]
+  return os.path.join(os.path.dirname(path), '.cache', '%s_%s' % (name, task))
+
+def cached(path, task):
+  try:
+    with open(cache_file(path, task)) as file:
+      return file.read() == task_hash(path, task)
+  except FileNotFoundError:
+    return False
+
+def prove(sby, path, task):
+  result = subprocess.run([sby, '-f', os.path.basename(path), task], cwd=os.path.dirname(path) or '.', stdout=subprocess.DEVNULL)
+  if result.returncode == 0:
+    os.makedirs(os.path.dirname(cache_file(path, task)), exist_ok=True)
+    with open(cache_file(path, task), 'w') as file:
+      file.write(task_hash(path, task))
+  return result.returncode == 0
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('files', nargs='*', help='.sby files (default: all in this directory)')
+  parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of tasks to run in parallel')
+  parser.add_argument('-f', '--force', action='store_true', help='ignore cached results')
+  parser.add_argument('--sby', default='sby', help='sby executable')
+  args = parser.parse_args()
+  files = args.files
+  if files == []:
+    here = os.path.dirname(os.path.abspath(__file__))
+    files = sorted(os.path.join(here, f) for f in os.listdir(here) if f.endswith('.sby'))
+  jobs = {}
+  with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+    for path in files:
+      for task in sby_tasks(path):
+        name = '%s %s' % (os.path.basename(path), task)
+        if not args.force and cached(path, task):
+          print('%-30s PASS (cached)' % name)
+        else:
+          jobs[executor.submit(prove, args.sby, path, task)] = name
+    failed = []
+    for job in concurrent.futures.as_completed(jobs):
+      print('%-30s %s' % (jobs[job], 'PASS' if job.result() else 'FAIL'), flush=True)
+      if not job.result():
+        failed.append(jobs[job])
+  if failed != []:
+    print('failed: %s' % ', '.join(sorted(failed)))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -90,6 +90,17 @@ module bus_if(
 	end
 
 `ifdef FORMAL
+	// The properties are split into groups that can be proven separately
+	// (see fv/bus_if.sby), each macro set to assert or assume. A task assumes
+	// the groups its induction needs, proven by tasks that don't assume it in
+	// turn, and LIVENESS assumes all of them. Without FV_GROUP all groups are
+	// asserted.
+`ifndef FV_GROUP
+`define FV_STATE assert
+`define FV_HANDSHAKE assert
+`define FV_DATA assert
+`endif
+
 	initial begin
 		memory_state = MEMORY_IDLE;
 		memory_done = 1'b0;
@@ -109,19 +120,25 @@ module bus_if(
 	assume property ($fell(bus_handshake_ack) |-> $past(!bus_handshake_req));
 	assume property ((memory_read && $past(memory_read)) || (memory_write && $past(memory_write)) |-> $stable(memory_addr) && $stable(memory_wdata));
 
-	state_invariant: assert property (memory_state != MEMORY_IDLE |-> (memory_read || memory_write) && !memory_done);
-	done_one_cycle: assert property (memory_done |=> !memory_done);
-	done_only_if_active: assert property (memory_done |-> memory_read || memory_write);
-	req_only_when_active: assert property (memory_state == MEMORY_IDLE |-> !bus_handshake_req);
-	req_when_no_ack: assert property ($rose(bus_handshake_req) |-> !bus_handshake_ack);
-	req_falls_when_ack: assert property (!$initstate && $fell(bus_handshake_req) |-> bus_handshake_ack);
-	stable_bus_state: assert property (bus_handshake_req |-> $stable(bus_state));
-	no_bus_contention: assert property (bus_handshake_req && bus_state == 2'b10 |-> !bus_output_enable && !$past(bus_output_enable));
-	stable_bus_data_out: assert property (bus_handshake_req && bus_state != 2'b10 |-> bus_output_enable && $past(bus_output_enable) && $stable(bus_data_out));
-	latch_bus_data: assert property (memory_done && memory_read |-> memory_rdata == $past(bus_data_in));
-
-	stable_bus_output: assert property ((bus_handshake_req || bus_handshake_ack) && !bus_output_enable |=> !bus_output_enable);
-	stable_bus_output2: assert property (bus_handshake_req && !bus_output_enable |-> !$past(bus_output_enable));
+`ifdef FV_STATE
+	state_invariant: `FV_STATE property (memory_state != MEMORY_IDLE |-> (memory_read || memory_write) && !memory_done);
+	done_one_cycle: `FV_STATE property (memory_done |=> !memory_done);
+	done_only_if_active: `FV_STATE property (memory_done |-> memory_read || memory_write);
+	req_only_when_active: `FV_STATE property (memory_state == MEMORY_IDLE |-> !bus_handshake_req);
+`endif
+`ifdef FV_HANDSHAKE
+	req_when_no_ack: `FV_HANDSHAKE property ($rose(bus_handshake_req) |-> !bus_handshake_ack);
+	req_falls_when_ack: `FV_HANDSHAKE property (!$initstate && $fell(bus_handshake_req) |-> bus_handshake_ack);
+	stable_bus_state: `FV_HANDSHAKE property (bus_handshake_req |-> $stable(bus_state));
+`endif
+`ifdef FV_DATA
+	no_bus_contention: `FV_DATA property (bus_handshake_req && bus_state == 2'b10 |-> !bus_output_enable && !$past(bus_output_enable));
+	stable_bus_data_out: `FV_DATA property (bus_handshake_req && bus_state != 2'b10 |-> bus_output_enable && $past(bus_output_enable) && $stable(bus_data_out));
+	latch_bus_data: `FV_DATA property (memory_done && memory_read |-> memory_rdata == $past(bus_data_in));
+
+	stable_bus_output: `FV_DATA property ((bus_handshake_req || bus_handshake_ack) && !bus_output_enable |=> !bus_output_enable);
+	stable_bus_output2: `FV_DATA property (bus_handshake_req && !bus_output_enable |-> !$past(bus_output_enable));
+`endif
 
 `ifdef LIVENESS
 	assume property(bus_handshake_req |-> ##[1:5] bus_handshake_ack);
@@ -155,13 +155,21 @@ module cpu(
 		endcase
 	end
 
+    // The request is sampled at the end of every state and once more in the first
+    // clock of CPU_FETCH, before bus_if has put the fetch on the bus, so that a
+    // request arriving at the instruction boundary is still taken there. rIR still
+    // holds the last instruction then, after EI the next one has to run first.
     reg int_enabled;
     reg int_latch;
+    reg was_fetch;
+    wire int_sample = cycle_done || state == CPU_FETCH && !was_fetch && !int_latch && !iEI;
     always @(posedge clk or negedge rst_n) begin
         if(!rst_n) begin
             int_enabled <= 1'b0;
             int_latch <= 1'b0;
+            was_fetch <= 1'b0;
         end else begin
+            was_fetch <= state == CPU_FETCH;
             if(state == CPU_EIDI) begin
                 if(iEI)
                     int_enabled <= 1'b1;
@@ -170,7 +178,7 @@ module cpu(
             end
             if(cpu_int_ack)
                 int_enabled <= 1'b0;
-            if(cycle_done)
+            if(int_sample)
                 int_latch <= int_req && int_enabled && !(state == CPU_EIDI && iDI || cpu_int_ack);
         end
     end
@@ -313,7 +321,7 @@ module cpu(
 
 	wire cycle_done = !memory_read && !memory_write || memory_done;
 	wire pc_increment =
-		state == CPU_FETCH && !debug_req && !cpu_int_ack
+		state == CPU_FETCH && !break_req && !cpu_int_ack
         || state == CPU_MVI0 || state == CPU_JMP0 || state == CPU_JMP1 && iJMPcc && !condition
 		|| state == CPU_ALU0 && iALUI
 		|| state == CPU_LXI0 || state == CPU_LXI1
@@ -360,6 +368,11 @@ module cpu(
 	localparam DB_A = 5'b01111;
 	localparam DB_PCL = 5'b10000;
 	localparam DB_PCH = 5'b10001;
+	localparam DB_BP0L = 5'b10010;
+	localparam DB_BP0H = 5'b10011;
+	localparam DB_BP1L = 5'b10100;
+	localparam DB_BP1H = 5'b10101;
+	localparam DB_BPCTL = 5'b10110;
 
 	reg [7:0] DB;
 	always @(*) begin
@@ -381,9 +394,75 @@ module cpu(
 		DB_PCH: DB = rPC[15:8];
         DB_ALL: DB = AL[7:0];
         DB_ALH: DB = AL[15:8];
+        DB_BP0L: DB = bp0[7:0];
+        DB_BP0H: DB = bp0[15:8];
+        DB_BP1L: DB = bp1[7:0];
+        DB_BP1H: DB = bp1[15:8];
+        DB_BPCTL: DB = bp_ctl;
 		endcase
 	end
 
+    // Two breakpoint comparators, set through the debug registers. For each of them
+    // bp_ctl has the enables {write, read, fetch} in bits [2:0] and [6:4] and a hit
+    // flag in bit 3 and 7 that is set on a match and cleared by writing bp_ctl.
+    // A fetch match enters debug mode before the instruction is executed, a data
+    // match after the instruction that made the access. Leaving debug mode skips
+    // the fetch comparators once, so that execution can resume at a breakpoint.
+    reg [15:0] bp0, bp1;
+    reg [7:0] bp_ctl;
+    reg bp_skip;
+    reg bp_pending;
+    wire code_read =
+        state == CPU_FETCH || state == CPU_MVI0 || state == CPU_JMP0 || state == CPU_JMP1
+        || state == CPU_LXI0 || state == CPU_LXI1 || state == CPU_DIRECT0 || state == CPU_DIRECT1
+        || state == CPU_CALL0 || state == CPU_CALL1 || state == CPU_IO0
+        || state == CPU_ALU0 && iALUI;
+    wire data_access = (memory_read || memory_write) && !memory_io && !code_read;
+    // memory_addr is rPC in CPU_FETCH, so one comparator per breakpoint serves
+    // both kinds of match.
+    wire [1:0] bp_addr_match = {bp1 == memory_addr, bp0 == memory_addr};
+    wire [1:0] bp_data_match = bp_addr_match & {
+        memory_read && bp_ctl[5] || memory_write && bp_ctl[6],
+        memory_read && bp_ctl[1] || memory_write && bp_ctl[2]
+    } & {2{data_access}};
+    wire [1:0] bp_fetch_match = bp_addr_match & {bp_ctl[4], bp_ctl[0]} & {2{state == CPU_FETCH && !bp_skip && !int_latch}};
+    wire break_req = debug_req || bp_pending && !int_latch || |bp_fetch_match;
+
+    always @(posedge clk or negedge rst_n) begin
+        if(!rst_n) begin
+            bp0 <= 0;
+            bp1 <= 0;
+            bp_ctl <= 0;
+            bp_skip <= 1'b0;
+            bp_pending <= 1'b0;
+        end else begin
+            if(cycle_done) begin
+                if(db_dst == DB_BP0L)
+                    bp0[7:0] <= DB;
+                if(db_dst == DB_BP0H)
+                    bp0[15:8] <= DB;
+                if(db_dst == DB_BP1L)
+                    bp1[7:0] <= DB;
+                if(db_dst == DB_BP1H)
+                    bp1[15:8] <= DB;
+                if(db_dst == DB_BPCTL)
+                    bp_ctl <= DB;
+                if(|bp_data_match)
+                    bp_pending <= 1'b1;
+                if(bp_data_match[0] || bp_fetch_match[0])
+                    bp_ctl[3] <= 1'b1;
+                if(bp_data_match[1] || bp_fetch_match[1])
+                    bp_ctl[7] <= 1'b1;
+                if(state == CPU_FETCH)
+                    bp_skip <= 1'b0;
+                if(cpu_in_debug)
+                    bp_pending <= 1'b0;
+                if(state == CPU_DEBUG1 && dbgEXIT)
+                    bp_skip <= 1'b1;
+            end
+        end
+    end
+
 	always @(posedge clk or negedge rst_n) begin
 		if(!rst_n) begin
 			rPC <= 0;
@@ -460,7 +539,7 @@ module cpu(
 			if(cycle_done) begin
 				case(state)
 				CPU_FETCH:
-                    if(debug_req)
+                    if(break_req)
                         state <= CPU_DEBUG0;
                     else
 					    state <= CPU_DECODE;
@@ -469,7 +548,7 @@ module cpu(
                 CPU_HALT:
                     if(debug_req)
                         state <= CPU_DEBUG0;
-                    else if(int_latch)
+                    else if(int_req && int_enabled)
                         state <= CPU_FETCH;
 				CPU_MVI0:
 					state <= memory_operand ? CPU_MVI1 : CPU_FETCH;
@@ -951,6 +1030,19 @@ module cpu(
 	end
 
 `ifdef FORMAL
+    // The properties are split into groups that can be proven separately
+    // (see fv/cpu.sby), each macro set to assert or assume. A task assumes
+    // the groups its induction needs, proven by tasks that don't assume it in
+    // turn, and LIVENESS assumes all of them. Without FV_GROUP all groups are
+    // asserted.
+`ifndef FV_GROUP
+`define FV_BUS assert
+`define FV_STATE_ALU assert
+`define FV_STATE_MEM assert
+`define FV_STATE_FLOW assert
+`define FV_DECODE assert
+`endif
+
     initial state = CPU_FETCH;
 
 	default clocking
@@ -961,42 +1053,52 @@ module cpu(
     assume property (memory_done |=> !memory_done);
     assume property (debug_req && !cpu_in_debug |=> debug_req);
 
-    read_until_done: assert property (memory_read && !memory_done |=> memory_read);
-    write_until_done: assert property (memory_write && !memory_done |=> memory_write);
-    not_read_and_write: assert property (!memory_read || !memory_write);
-    stable_memory_addr: assert property (!$initstate && (memory_read && $past(memory_read) || memory_write && $past(memory_write)) && !$past(memory_done) |-> $stable(memory_addr) && $stable(memory_io));
-    stable_memory_wdata: assert property (!$initstate && memory_write && $past(memory_write) && !$past(memory_done) && state != CPU_DEBUG1 |-> $stable(memory_wdata));
-
-    assert property (state == CPU_ALU0 || state == CPU_ALU1 |-> iALU || iALUI);
-    assert property (state == CPU_HALT |-> iHALT);
-    assert property (state == CPU_POP0 || state == CPU_POP1 |-> iPOP);
-    assert property (state == CPU_PUSH0 || state == CPU_PUSH1 || state == CPU_PUSH2 |-> iPUSH);
-    assert property (state == CPU_PCHL0 || state == CPU_PCHL1 || state == CPU_PCHL2 |-> iPCHL);
-    assert property (state == CPU_RET0 || state == CPU_RET1 |-> iRET || iRETcc);
-    assert property (state == CPU_UNARY |-> iUNARY);
-    assert property (state == CPU_INRDCR0 || state == CPU_INRDCR1 |-> iINR || iDCR);
-    assert property (state == CPU_DAD0 || state == CPU_DAD1 || state == CPU_DAD2 || state == CPU_DAD3 || state == CPU_DAD4 || state == CPU_DAD5 || state == CPU_DAD6 || state == CPU_DAD7 |-> iDAD);
-    assert property (state == CPU_JMP0 || state == CPU_JMP1 |-> iJMP || iJMPcc);
-    assert property (state == CPU_INXDCX0 || state == CPU_INXDCX1 || state == CPU_INXDCX2 || state == CPU_INXDCX3 |-> iINX || iDCX);
-    assert property (state == CPU_MOV |-> iMOV);
-    assert property (state == CPU_DIRECT0 || state == CPU_DIRECT1 || state == CPU_DIRECT2 |-> iLDA || iSTA || iLHLD || iSHLD);
-    assert property (state == CPU_DIRECT3 |-> iLHLD || iSHLD);
-    assert property (state == CPU_MVI0 || state == CPU_MVI1 |-> iMVI);
-    assert property (state == CPU_LXI0 || state == CPU_LXI1 |-> iLXI);
-    assert property (state == CPU_LDAXSTAX0 || state == CPU_LDAXSTAX1 || state == CPU_LDAXSTAX2 |-> iLDAX || iSTAX);
-    assert property (state == CPU_SPHL0 || state == CPU_SPHL1 |-> iSPHL);
-    assert property (state == CPU_IO0 || state == CPU_IO1 |-> iIN || iOUT);
-    assert property (state == CPU_CALL0 || state == CPU_CALL1 || state == CPU_CALL2 || state == CPU_CALL3 |-> iCALL || iCALLcc || iRST);
-    assert property (state == CPU_XCHG0 || state == CPU_XCHG1 || state == CPU_XCHG2 || state == CPU_XCHG3 || state == CPU_XCHG4 || state == CPU_XCHG5 |-> iXCHG || iXTHL);
-    assert property (state == CPU_EIDI |-> iEI || iDI);
-
-    exactly_one_decode: assert property ($onehot({
+`ifdef FV_BUS
+    read_until_done: `FV_BUS property (memory_read && !memory_done |=> memory_read);
+    write_until_done: `FV_BUS property (memory_write && !memory_done |=> memory_write);
+    not_read_and_write: `FV_BUS property (!memory_read || !memory_write);
+    stable_memory_addr: `FV_BUS property (!$initstate && (memory_read && $past(memory_read) || memory_write && $past(memory_write)) && !$past(memory_done) |-> $stable(memory_addr) && $stable(memory_io));
+    stable_memory_wdata: `FV_BUS property (!$initstate && memory_write && $past(memory_write) && !$past(memory_done) && state != CPU_DEBUG1 |-> $stable(memory_wdata));
+`endif
+
+`ifdef FV_STATE_ALU
+    `FV_STATE_ALU property (state == CPU_ALU0 || state == CPU_ALU1 |-> iALU || iALUI);
+    `FV_STATE_ALU property (state == CPU_UNARY |-> iUNARY);
+    `FV_STATE_ALU property (state == CPU_INRDCR0 || state == CPU_INRDCR1 |-> iINR || iDCR);
+    `FV_STATE_ALU property (state == CPU_DAD0 || state == CPU_DAD1 || state == CPU_DAD2 || state == CPU_DAD3 || state == CPU_DAD4 || state == CPU_DAD5 || state == CPU_DAD6 || state == CPU_DAD7 |-> iDAD);
+    `FV_STATE_ALU property (state == CPU_INXDCX0 || state == CPU_INXDCX1 || state == CPU_INXDCX2 || state == CPU_INXDCX3 |-> iINX || iDCX);
+    `FV_STATE_ALU property (state == CPU_MOV |-> iMOV);
+    `FV_STATE_ALU property (state == CPU_MVI0 || state == CPU_MVI1 |-> iMVI);
+`endif
+`ifdef FV_STATE_MEM
+    `FV_STATE_MEM property (state == CPU_POP0 || state == CPU_POP1 |-> iPOP);
+    `FV_STATE_MEM property (state == CPU_PUSH0 || state == CPU_PUSH1 || state == CPU_PUSH2 |-> iPUSH);
+    `FV_STATE_MEM property (state == CPU_DIRECT0 || state == CPU_DIRECT1 || state == CPU_DIRECT2 |-> iLDA || iSTA || iLHLD || iSHLD);
+    `FV_STATE_MEM property (state == CPU_DIRECT3 |-> iLHLD || iSHLD);
+    `FV_STATE_MEM property (state == CPU_LXI0 || state == CPU_LXI1 |-> iLXI);
+    `FV_STATE_MEM property (state == CPU_LDAXSTAX0 || state == CPU_LDAXSTAX1 || state == CPU_LDAXSTAX2 |-> iLDAX || iSTAX);
+    `FV_STATE_MEM property (state == CPU_SPHL0 || state == CPU_SPHL1 |-> iSPHL);
+    `FV_STATE_MEM property (state == CPU_IO0 || state == CPU_IO1 |-> iIN || iOUT);
+    `FV_STATE_MEM property (state == CPU_XCHG0 || state == CPU_XCHG1 || state == CPU_XCHG2 || state == CPU_XCHG3 || state == CPU_XCHG4 || state == CPU_XCHG5 |-> iXCHG || iXTHL);
+`endif
+`ifdef FV_STATE_FLOW
+    `FV_STATE_FLOW property (state == CPU_HALT |-> iHALT);
+    `FV_STATE_FLOW property (state == CPU_PCHL0 || state == CPU_PCHL1 || state == CPU_PCHL2 |-> iPCHL);
+    `FV_STATE_FLOW property (state == CPU_RET0 || state == CPU_RET1 |-> iRET || iRETcc);
+    `FV_STATE_FLOW property (state == CPU_JMP0 || state == CPU_JMP1 |-> iJMP || iJMPcc);
+    `FV_STATE_FLOW property (state == CPU_CALL0 || state == CPU_CALL1 || state == CPU_CALL2 || state == CPU_CALL3 |-> iCALL || iCALLcc || iRST);
+    `FV_STATE_FLOW property (state == CPU_EIDI |-> iEI || iDI);
+`endif
+
+`ifdef FV_DECODE
+    exactly_one_decode: `FV_DECODE property ($onehot({
         iMOV, iALU, iALUI, iMVI, iJMP, iPUSH, iPOP, iHALT, iLXI, iLDA, iSTA, iLHLD, iSHLD,
         iUNARY, iCALL, iCALLcc, iRST, iRET, iRETcc, iJMPcc, iPCHL, iSPHL, iINR, iDCR,
         iINX, iDCX, iLDAX, iSTAX, iXCHG, iXTHL, iDAD, iIN, iOUT, iNOP, iEI, iDI,
         undefined}));
-    inx_sp_dcx_sp: assert property ((!iINX_SP || iINX) && (!iDCX_SP || iDCX));
-    no_missing_cases: assert property (!missing_decoder_case);
+    inx_sp_dcx_sp: `FV_DECODE property ((!iINX_SP || iINX) && (!iDCX_SP || iDCX));
+    no_missing_cases: `FV_DECODE property (!missing_decoder_case);
+`endif
 
 
 `ifdef LIVENESS
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Merges the coverage files written by make COVERAGE=yes (see coverage.v) and
+# reports the bins that were hit. With --select, picks a small set of files
+# (tests and seeds) that together hit the same bins and lists the ones that add
+# nothing; --prune deletes those.
+#
+# --run N picks the tests and seeds that cover every CPU state, instruction
+# class (decode target) and bus phase the files have hit for the fewest clocks,
+# and runs them in N make processes, by default at gate level (GATES=yes).
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+
+groups = ['transitions', 'opcodes', 'decode', 'conditions', 'bus_phases', 'bus_sequences']
+# bins that can be hit at all, for groups where that is known
+sizes = {'opcodes': 256, 'conditions': 128}
+conditions = ['NZ', 'Z', 'NC', 'C', 'PO', 'PE', 'P', 'M']
+accesses = ['read', 'write', 'in', 'out']
+
+def localparams(path, prefix):
+  names = {}
+  with open(path) as file:
+    for m in re.finditer(r'localparam\s+(%s\w+)\s*=\s*(\d+)' % prefix, file.read()):
+      names[int(m.group(2))] = m.group(1)[len(prefix):]
+  return names
+
+here = os.path.dirname(os.path.abspath(__file__))
+cpu_states = localparams(os.path.join(here, '../src/cpu.v'), 'CPU_')
+memory_states = localparams(os.path.join(here, '../src/bus_if.v'), 'MEMORY_')
+
+def bin_name(group, n):
+  if group == 'transitions':
+    return '%s -> %s' % (cpu_states.get(n >> 6, n >> 6), cpu_states.get(n & 63, n & 63))
+  if group == 'opcodes':
+    return '%.2x' % n
+  if group == 'decode':
+    return cpu_states.get(n, str(n))
+  if group == 'conditions':
+    return '%-2s %s' % (conditions[n >> 4], ' '.join(f if n & m else '-' for f, m in zip('SZPC', [8, 4, 2, 1])))
+  if group == 'bus_phases':
+    return '%-5s %s -> %s' % (accesses[n >> 4], memory_states[n >> 2 & 3], memory_states[n & 3])
+  if group == 'bus_sequences':
+    return '%-5s then %-5s%s' % (accesses[n >> 3], accesses[n >> 1 & 3], ' back to back' if n & 1 else '')
+
+def load(path):
+  with open(path) as file:
+    data = json.load(file)
+  return {(group, n) for group in groups for n in range(4 * len(data[group])) if int(data[group], 16) >> n & 1}
+
+def load_info(path):
+  with open(path) as file:
+    data = json.load(file)
+  return (data['test'], data.get('program', False), data['seed'], max(data.get('clocks', 1), 1))
+
+# The bins a gate level run has to keep: the states entered, the decode targets
+# and the bus phases.
+def gate_bins(bins):
+  return {('states', n & 63) for g, n in bins if g == 'transitions'} | {(g, n) for g, n in bins if g in ('decode', 'bus_phases')}
+
+def report(bins, verbose):
+  for group in groups:
+    hit = sorted(n for g, n in bins if g == group)
+    if group in sizes:
+      print('%-14s %5d / %d' % (group, len(hit), sizes[group]))
+    else:
+      print('%-14s %5d' % (group, len(hit)))
+    if verbose:
+      for n in hit:
+        print(('    %s' % bin_name(group, n)).rstrip())
+      if group in sizes and len(hit) < sizes[group]:
+        print('  missing:')
+        for n in sorted(set(range(sizes[group])) - set(hit)):
+          print(('    %s' % bin_name(group, n)).rstrip())
+
+# Greedy set cover: repeatedly takes the file that adds the most bins not yet
+# covered, until none adds anything.
+def select(coverage):
+  covered = set()
+  kept = []
+  left = dict(coverage)
+  while left:
+    path = max(sorted(left), key=lambda p: len(left[p] - covered))
+    if not left[path] - covered:
+      break
+    covered |= left.pop(path)
+    kept.append(path)
+  return kept, sorted(left)
+
+# Like select(), but takes the file with the most new bins per clock.
+def select_cheapest(coverage, cost):
+  covered = set()
+  kept = []
+  left = dict(coverage)
+  while left:
+    path = max(sorted(left), key=lambda p: len(left[p] - covered) / cost[p])
+    if not left[path] - covered:
+      break
+    covered |= left.pop(path)
+    kept.append(path)
+  return kept
+
+# Splits the runs over n shards, the longest first onto the shard with the
+# fewest clocks so far.
+def shards(runs, n):
+  clocks = [0] * n
+  programs = [[] for i in range(n)]
+  tests = [[] for i in range(n)]
+  for (cost, test, program, seed) in sorted(runs, reverse=True):
+    i = clocks.index(min(clocks))
+    if program:
+      programs[i].append('%s:%d' % (test, seed))
+    elif not any(test in t for t in tests):
+      tests[i].append(test)
+    clocks[i] += cost
+  return [(programs[i], tests[i]) for i in range(n) if programs[i] != [] or tests[i] != []]
+
+def run_shard(make, n, programs, tests):
+  results = os.path.join(here, 'results_shard%d.xml' % n)
+  if os.path.exists(results):
+    os.remove(results)
+  testcase = ','.join((['test_selected'] if programs != [] else []) + tests)
+  with open(os.path.join(here, 'shard%d.log' % n), 'w') as log:
+    # the shards share this directory, so they must not all dump waves to tb.vcd
+    subprocess.run(make + ['TESTCASE=' + testcase, 'PROGRAMS=' + ','.join(programs), 'COCOTB_RESULTS_FILE=' + results, 'PLUSARGS=+nodump'], cwd=here, stdout=log, stderr=subprocess.STDOUT)
+  try:
+    with open(results) as file:
+      return not '<failure' in file.read()
+  except FileNotFoundError:
+    return False
+
+def run(coverage, jobs, make):
+  info = {path: load_info(path) for path in coverage}
+  kept = select_cheapest({path: gate_bins(bins) for path, bins in coverage.items()}, {path: info[path][3] for path in coverage})
+  bins = set().union(*coverage.values())
+  selected = set().union(*(coverage[path] for path in kept))
+  print('%d of %d files, %d of %d clocks' % (len(kept), len(coverage), sum(info[p][3] for p in kept), sum(info[p][3] for p in coverage)))
+  for group in ['states'] + groups:
+    (hit, total) = (gate_bins(selected), gate_bins(bins)) if group == 'states' else (selected, bins)
+    print('%-14s %5d / %d kept' % (group, sum(1 for g, n in hit if g == group), sum(1 for g, n in total if g == group)))
+  runs = [(clocks, test, program, seed) for (test, program, seed, clocks) in (info[path] for path in kept)]
+  make = shlex.split(make)
+  if subprocess.run(make + ['build'], cwd=here).returncode != 0:
+    sys.exit('build failed')
+  failed = []
+  with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+    started = {executor.submit(run_shard, make, n, programs, tests): (n, programs, tests) for n, (programs, tests) in enumerate(shards(runs, jobs))}
+    for job in concurrent.futures.as_completed(started):
+      (n, programs, tests) = started[job]
+      print('shard %d: %-4s %s' % (n, 'PASS' if job.result() else 'FAIL', ' '.join(programs + tests)), flush=True)
+      if not job.result():
+        failed.append('shard%d.log' % n)
+  if failed != []:
+    print('failed: %s' % ', '.join(sorted(failed)))
+    sys.exit(1)
+
+def save(path, bins):
+  data = {'test': 'merged', 'seed': None}
+  for group in groups:
+    data[group] = '%x' % sum(1 << n for g, n in bins if g == group)
+  with open(path, 'w') as file:
+    json.dump(data, file)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('files', nargs='*', help='coverage files (default: all in coverage/)')
+  parser.add_argument('-v', '--verbose', action='store_true', help='list the bins')
+  parser.add_argument('-o', '--output', help='write the merged coverage to this file')
+  parser.add_argument('--select', action='store_true', help='list the files that add no coverage')
+  parser.add_argument('--prune', action='store_true', help='delete the files that add no coverage')
+  parser.add_argument('--run', type=int, metavar='N', help='run a selection covering all states, decode targets and bus phases in N processes')
+  parser.add_argument('--make', default='make GATES=yes', help='make command for --run (default: %(default)s)')
+  args = parser.parse_args()
+  files = args.files
+  if files == []:
+    directory = os.path.join(here, 'coverage')
+    files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.json'))
+  if files == []:
+    sys.exit('no coverage files')
+  coverage = {path: load(path) for path in files}
+  bins = set().union(*coverage.values())
+  report(bins, args.verbose)
+  if args.output:
+    save(args.output, bins)
+  if args.run:
+    run(coverage, args.run, args.make)
+  elif args.select or args.prune:
+    kept, dropped = select(coverage)
+    print('%d of %d files cover all bins' % (len(kept), len(files)))
+    for path in kept:
+      print('keep %s' % path)
+    for path in dropped:
+      print('drop %s' % path)
+      if args.prune:
+        os.remove(path)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,81 @@
+`default_nettype none `timescale 1ns / 1ps
+
+/* Coverage collector for the RTL simulation (make COVERAGE=yes), instantiated
+   by tb.v. It only sets bits in a few wide registers, which test.py reads once
+   at the end of a test, so it costs nothing on the cocotb side. Reset clears them.
+*/
+module coverage (
+    input wire clk,
+    input wire rst_n,
+    input wire [5:0] state,
+    input wire [5:0] decode_goto,
+    input wire [7:0] ir,
+    input wire [7:0] psr,
+    input wire [1:0] memory_state,
+    input wire memory_write,
+    input wire memory_io,
+    input wire memory_done
+);
+
+  localparam CPU_DECODE = 1;
+  localparam MEMORY_IDLE = 0;
+  localparam MEMORY_ADDR_LOW = 1;
+
+  // indexed by {previous state, state}
+  reg [4095:0] transitions;
+  // indexed by the opcode and the decode_goto target in CPU_DECODE
+  reg [255:0] opcodes;
+  reg [63:0] decode;
+  // conditional instructions in CPU_DECODE, indexed by {condition, S, Z, P, C}
+  reg [127:0] conditions;
+  // bus_if state changes, indexed by {io, write, previous state, state}
+  reg [63:0] bus_phases;
+  // consecutive accesses, indexed by {io, write of the previous access, io, write, back to back}
+  reg [31:0] bus_sequences;
+
+  reg [5:0] last_state;
+  reg [1:0] last_memory_state;
+  reg last_io, last_write;
+  reg [1:0] last_access;
+  reg done_1, done_2;
+
+  wire conditional = ir[7:6] == 3 && (ir[2:0] == 0 || ir[2:0] == 2 || ir[2:0] == 4);
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      transitions <= 0;
+      opcodes <= 0;
+      decode <= 0;
+      conditions <= 0;
+      bus_phases <= 0;
+      bus_sequences <= 0;
+      last_state <= 0;
+      last_memory_state <= MEMORY_IDLE;
+      last_io <= 1'b0;
+      last_write <= 1'b0;
+      last_access <= 0;
+      done_1 <= 1'b0;
+      done_2 <= 1'b0;
+    end else begin
+      last_state <= state;
+      last_memory_state <= memory_state;
+      last_io <= memory_io;
+      last_write <= memory_write;
+      done_1 <= memory_done;
+      done_2 <= done_1;
+      if (state != last_state) transitions[{last_state, state}] <= 1'b1;
+      if (state == CPU_DECODE) begin
+        opcodes[ir] <= 1'b1;
+        decode[decode_goto] <= 1'b1;
+        if (conditional) conditions[{ir[5:3], psr[7], psr[6], psr[2], psr[0]}] <= 1'b1;
+      end
+      if (memory_state != last_memory_state)
+        bus_phases[{last_io, last_write, last_memory_state, memory_state}] <= 1'b1;
+      if (last_memory_state == MEMORY_IDLE && memory_state == MEMORY_ADDR_LOW) begin
+        bus_sequences[{last_access, last_io, last_write, done_2}] <= 1'b1;
+        last_access <= {last_io, last_write};
+      end
+    end
+  end
+
+endmodule
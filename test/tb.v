@@ -6,9 +6,12 @@
 module tb ();
 
   // Dump the signals to a VCD file. You can view it with gtkwave.
+  // +nodump turns it off, for the shards of cover.py --run.
   initial begin
-    $dumpfile("tb.vcd");
-    $dumpvars(0, tb);
+    if (!$test$plusargs("nodump")) begin
+      $dumpfile("tb.vcd");
+      $dumpvars(0, tb);
+    end
     #1;
   end
 
@@ -41,4 +44,19 @@ module tb ();
       .rst_n  (rst_n)     // not reset
   );
 
+`ifdef COVERAGE
+  coverage cov (
+      .clk         (clk),
+      .rst_n       (rst_n),
+      .state       (user_project.cpu_i.state),
+      .decode_goto (user_project.cpu_i.decode_goto),
+      .ir          (user_project.cpu_i.rIR),
+      .psr         (user_project.cpu_i.rPSR),
+      .memory_state(user_project.bus_if_i.memory_state),
+      .memory_write(user_project.memory_write),
+      .memory_io   (user_project.memory_io),
+      .memory_done (user_project.memory_done)
+  );
+`endif
+
 endmodule
@@ -0,0 +1,64 @@
+`default_nettype none `timescale 1ns / 1ps
+
+/* This testbench instantiates CORES independent copies of the module so that
+   test_multi.py can run several test programs concurrently in one simulation.
+   Every copy has its own reset and I/O wiring, only the clock is shared.
+*/
+`ifndef CORES
+`define CORES 4
+`endif
+
+module tb_multi ();
+
+  // Dump the signals to a VCD file. You can view it with gtkwave.
+  initial begin
+    $dumpfile("tb_multi.vcd");
+    $dumpvars(0, tb_multi);
+    #1;
+  end
+
+  parameter CORES = `CORES;
+
+  reg clk;
+
+  genvar i;
+  generate
+    for (i = 0; i < CORES; i = i + 1) begin : core
+      tb_core core_i (.clk(clk));
+    end
+  endgenerate
+
+endmodule
+
+module tb_core (
+    input wire clk
+);
+
+  // Wire up the inputs and outputs:
+  reg rst_n;
+  reg ena;
+  reg [7:0] ui_in;
+  reg [7:0] uio_in;
+  wire [7:0] uo_out;
+  wire [7:0] uio_out;
+  wire [7:0] uio_oe;
+
+  tt_um_aiju_8080 user_project (
+
+      // Include power ports for the Gate Level test:
+`ifdef GL_TEST
+      .VPWR(1'b1),
+      .VGND(1'b0),
+`endif
+
+      .ui_in  (ui_in),    // Dedicated inputs
+      .uo_out (uo_out),   // Dedicated outputs
+      .uio_in (uio_in),   // IOs: Input path
+      .uio_out(uio_out),  // IOs: Output path
+      .uio_oe (uio_oe),   // IOs: Enable path (active high: 0=input, 1=output)
+      .ena    (ena),      // enable - goes high when design is selected
+      .clk    (clk),      // clock
+      .rst_n  (rst_n)     // not reset
+  );
+
+endmodule
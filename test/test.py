@@ -7,40 +7,85 @@ from cocotb.triggers import ClockCycles, Timer
 import random
 from functools import reduce
 import operator
+import difflib
+import os
+import collections
+import bisect
+import re
+import json
+import hashlib
+import numpy
+import cover
 
+# Pages (256 bytes) that have been written are marked dirty, so that two
+# memories that started out the same can be compared by only those pages.
 class Memory:
   def __init__(self):
     self.contents = list(random.randbytes(65536))
     self.ptr = 0
+    self.dirty = bytearray(256)
   def read(self, addr):
     return self.contents[addr]
   def write(self, addr, value):
     assert value >= 0 and value <= 255
     self.contents[addr] = value
+    self.dirty[addr >> 8] = 1
+  def clean(self):
+    self.dirty = bytearray(256)
+  def diff(self, other):
+    result = []
+    for page in range(256):
+      if self.dirty[page] or other.dirty[page]:
+        lo = page << 8
+        if self.contents[lo:lo + 256] != other.contents[lo:lo + 256]:
+          result += [addr for addr in range(lo, lo + 256) if self.contents[addr] != other.contents[addr]]
+    return result
   def append(self, values):
     for i in values:
       self.write(self.ptr, i)
       self.ptr += 1
+  def copy(self):
+    memory = Memory.__new__(Memory)
+    memory.contents = list(self.contents)
+    memory.ptr = self.ptr
+    memory.dirty = bytearray(self.dirty)
+    return memory
 
 class RandomIOModel:
+  def __init__(self, seed=None):
+    self.random = random.Random(random.getrandbits(32) if seed is None else seed)
   def io_in(self, port):
-    return random.randint(0, 255)
+    return self.random.randint(0, 255)
   def io_out(self, port, data):
     pass
 
 class BusModel:
-  def __init__(self, memory, io_model, dut):
+  def __init__(self, memory, io_model, dut, responder=None):
     self.memory = memory
     self.io_model = io_model
     self.dut = dut
+    self.responder = responder if responder is not None else FixedLatency()
+    self.access_clock = None
+    # clocks the responder added to the last access, for BusTiming
+    self.latency = 0
+    self.int_delay = None
+    self.int_request = None
+    self.int_latency = []
+    self.inputs = 0
+  # ui_in is written from several coroutines, so it is only ever set from this copy
+  def set_input(self, bit, value):
+    self.inputs = self.inputs | bit if value else self.inputs & ~bit
+    self.dut.ui_in.value = self.inputs
   async def handshake_begin(self):
     while (self.dut.uo_out.value & 1) == 0:
       await ClockCycles(self.dut.clk, 1)
-  async def handshake_end(self):
-    self.dut.ui_in.value = self.dut.ui_in.value | 1
+  async def handshake_end(self, latency=0):
+    if latency > 0:
+      await ClockCycles(self.dut.clk, latency)
+    self.set_input(1, True)
     while (self.dut.uo_out.value & 1) != 0:
       await ClockCycles(self.dut.clk, 1)
-    self.dut.ui_in.value = self.dut.ui_in.value & ~1
+    self.set_input(1, False)
   def read_bus(self):
     assert self.dut.uio_oe.value == 0xff
     return self.dut.uio_out.value
@@ -51,20 +96,33 @@ class BusModel:
     self.dut.uio_in.value = cocotb.binary.BinaryValue('xxxxxxxx')
   def assert_state(self, state, io):
     assert (self.dut.uo_out.value >> 1 & 7) == (state | int(io) << 2)
+  def clock(self):
+    return round(cocotb.utils.get_sim_time('ns') / 1000)
+  def access_begin(self):
+    self.access_clock = self.clock()
+    self.latency = 0
+    if self.int_delay is not None:
+      self.start_int_req(self.int_delay)
+      self.int_delay = None
+  def respond(self, state, addr, io):
+    clocks = self.responder.latency(state, addr, io)
+    self.latency += clocks
+    return clocks
   async def bus_read(self, addr, value, io):
     await self.handshake_begin()
+    self.access_begin()
     self.assert_state(0, io)
     assert self.read_bus() == (addr & 0xff)
-    await self.handshake_end()
+    await self.handshake_end(self.respond(0, addr, io))
     await self.handshake_begin()
     self.assert_state(1, io)
     assert self.read_bus() == (addr >> 8)
-    await self.handshake_end()
+    await self.handshake_end(self.respond(1, addr, io))
     await self.handshake_begin()
     self.assert_state(2, io)
     self.write_bus(value)
     await ClockCycles(self.dut.clk, 1)
-    await self.handshake_end()
+    await self.handshake_end(self.respond(2, addr, io))
     self.clear_bus()
   async def read(self, addr, io=False):
     if io:
@@ -85,17 +143,18 @@ class BusModel:
     await self.handshake_end()
   async def bus_write(self, addr, io):
     await self.handshake_begin()
+    self.access_begin()
     self.assert_state(0, io)
     assert self.read_bus() == (addr & 0xff)
-    await self.handshake_end()
+    await self.handshake_end(self.respond(0, addr, io))
     await self.handshake_begin()
     self.assert_state(1, io)
     assert self.read_bus() == (addr >> 8)
-    await self.handshake_end()
+    await self.handshake_end(self.respond(1, addr, io))
     await self.handshake_begin()
     self.assert_state(3, io)
     value = self.read_bus()
-    await self.handshake_end()
+    await self.handshake_end(self.respond(3, addr, io))
     return value
   async def write(self, addr, value, io=False):
     if io:
@@ -107,13 +166,13 @@ class BusModel:
     await ClockCycles(self.dut.clk, 20)
     assert (self.dut.uo_out.value & 0x40) != 0
   async def enter_debug(self):
-    self.dut.ui_in.value = self.dut.ui_in.value | 2
+    self.set_input(2, True)
     await ClockCycles(self.dut.clk, 1)
     if (self.dut.uo_out.value & 0x40) == 0:
       await self.dummy_read(False)
     await ClockCycles(self.dut.clk, 20)
     assert (self.dut.uo_out.value & 0x20) != 0
-    self.dut.ui_in.value = self.dut.ui_in.value & ~2
+    self.set_input(2, False)
     await ClockCycles(self.dut.clk, 1)
   async def debug_read(self, addr):
     await self.bus_read(0xcafe, addr, True)
@@ -125,18 +184,146 @@ class BusModel:
     await self.bus_read(0xcafe, 0x40, True)
     while (self.dut.uo_out.value & 0x20) != 0:
       await ClockCycles(self.dut.clk, 1)
-  async def set_int_req(self):
-    await ClockCycles(self.dut.clk, 1)
-    self.dut.ui_in.value = self.dut.ui_in.value | 4
-    await ClockCycles(self.dut.clk, 1)
+  async def set_int_req(self, delay):
+    if delay > 0:
+      await ClockCycles(self.dut.clk, delay)
+    self.set_input(4, True)
+    start = self.clock()
+    while (self.dut.uo_out.value & 0x80) == 0:
+      await ClockCycles(self.dut.clk, 1)
+    self.int_latency.append(self.clock() - start)
+  def start_int_req(self, delay):
+    self.int_request = cocotb.start_soon(self.set_int_req(delay))
   async def int_ack(self):
-    await ClockCycles(self.dut.clk, 10)
-    assert (self.dut.uo_out.value & 0x80) != 0x00
-    self.dut.ui_in.value = self.dut.ui_in.value & ~4
+    assert self.int_request is not None
+    await self.int_request
+    self.int_request = None
+    self.set_input(4, False)
     await ClockCycles(self.dut.clk, 1)
 
+# Responder models return the clocks the RP2040 takes to acknowledge a handshake
+# in the given bus state (0/1 address low/high, 2 read data, 3 write data). They
+# get the full address even for state 0, where the real firmware has only seen
+# the low byte.
+class FixedLatency:
+  def __init__(self, *clocks):
+    assert len(clocks) in (0, 1, 4)
+    self.clocks = clocks or (0,)
+  def latency(self, state, addr, io):
+    return self.clocks[state if len(self.clocks) == 4 else 0]
+
+class RandomLatency:
+  def __init__(self, low, high, seed):
+    self.low = low
+    self.high = high
+    self.random = random.Random(seed)
+  def latency(self, state, addr, io):
+    return self.random.randint(self.low, self.high)
+
+# Replays latencies recorded on the firmware, one "<bus state> <clocks>" pair per
+# line. Each bus state goes through its own entries in a loop.
+class TraceLatency:
+  def __init__(self, path):
+    self.trace = {0: [], 1: [], 2: [], 3: []}
+    with open(path) as file:
+      for line in file:
+        if line.strip() != '' and not line.startswith('#'):
+          (state, clocks) = line.split()
+          self.trace[int(state)].append(int(clocks))
+    self.count = {0: 0, 1: 0, 2: 0, 3: 0}
+  def latency(self, state, addr, io):
+    if self.trace[state] == []:
+      return 0
+    clocks = self.trace[state][self.count[state] % len(self.trace[state])]
+    self.count[state] += 1
+    return clocks
+
+class RegionLatency:
+  def __init__(self, regions, default):
+    self.regions = regions
+    self.default = default
+  def latency(self, state, addr, io):
+    for (low, high, region_io, responder) in self.regions:
+      if io == region_io and low <= addr <= high:
+        return responder.latency(state, addr, io)
+    return self.default.latency(state, addr, io)
+
+# Builds a responder from a description like "fixed:1", "fixed:0/0/2/1" (per bus
+# state), "random:0-4" or "trace:file.txt". A comma separated list assigns them
+# to address regions, e.g. "io=random:2-8,0000-1fff=fixed:1,fixed:3"; the entry
+# without a region is used for everything else. Responders built from the same
+# description and seed produce the same latencies, so a program can be run
+# again with the same bus timing.
+def responder(spec, seed=0):
+  regions = []
+  default = FixedLatency()
+  for n, item in enumerate(spec.split(',')):
+    (region, _, model) = item.rpartition('=')
+    (kind, _, args) = model.partition(':')
+    if kind == 'fixed':
+      r = FixedLatency(*(int(a) for a in args.split('/')))
+    elif kind == 'random':
+      (low, high) = args.split('-')
+      r = RandomLatency(int(low), int(high), seed + n)
+    elif kind == 'trace':
+      r = TraceLatency(args)
+    else:
+      raise Exception("unknown responder %s" % model)
+    if region == '':
+      default = r
+    elif region == 'io':
+      regions.append((0, 0xffff, True, r))
+    else:
+      (low, high) = region.split('-')
+      regions.append((int(low, 16), int(high, 16), False, r))
+  return RegionLatency(regions, default) if regions != [] else default
+
+# The clocks of bus accesses on the RTL, with the constants fitted under
+# Verilator, plus the latency the bus model's responder added. With strict,
+# check() asserts that every instruction fetch happens at exactly the estimated
+# clock; the test programs only do that with TIMING=1, since the handshakes with
+# the bench can take different clocks on other simulators.
+class BusTiming:
+  def __init__(self, setup=3, handshake=7, read_delay=1, turnaround=1, strict=False):
+    self.setup = setup
+    self.handshake = handshake
+    self.read_delay = read_delay
+    self.turnaround = turnaround
+    self.strict = strict
+    self.offset = None
+  def access(self, write, latency):
+    return self.setup + 3 * self.handshake + (0 if write else self.read_delay) + latency
+  def check(self, estimated, measured):
+    if measured is None or not self.strict:
+      return
+    if self.offset is None:
+      self.offset = measured - estimated
+    assert measured - estimated == self.offset, "timing mismatch, expected clock %d, got %d" % (estimated + self.offset, measured)
+
 cpu_opcodes = {}
-def instruction(opcode, fields={}, exclude=[]):
+cpu_states = {}
+cpu_names = {}
+
+# clock cycles of the instructions on an actual 8080, conditional calls and returns take 6 more if taken
+i8080_cycles = [
+  4, 10,  7,  5,  5,  5,  7,  4,  4, 10,  7,  5,  5,  5,  7,  4,
+  4, 10,  7,  5,  5,  5,  7,  4,  4, 10,  7,  5,  5,  5,  7,  4,
+  4, 10, 16,  5,  5,  5,  7,  4,  4, 10, 16,  5,  5,  5,  7,  4,
+  4, 10, 13,  5, 10, 10, 10,  4,  4, 10, 13,  5,  5,  5,  7,  4,
+  5,  5,  5,  5,  5,  5,  7,  5,  5,  5,  5,  5,  5,  5,  7,  5,
+  5,  5,  5,  5,  5,  5,  7,  5,  5,  5,  5,  5,  5,  5,  7,  5,
+  5,  5,  5,  5,  5,  5,  7,  5,  5,  5,  5,  5,  5,  5,  7,  5,
+  7,  7,  7,  7,  7,  7,  7,  7,  5,  5,  5,  5,  5,  5,  7,  5,
+  4,  4,  4,  4,  4,  4,  7,  4,  4,  4,  4,  4,  4,  4,  7,  4,
+  4,  4,  4,  4,  4,  4,  7,  4,  4,  4,  4,  4,  4,  4,  7,  4,
+  4,  4,  4,  4,  4,  4,  7,  4,  4,  4,  4,  4,  4,  4,  7,  4,
+  4,  4,  4,  4,  4,  4,  7,  4,  4,  4,  4,  4,  4,  4,  7,  4,
+  5, 10, 10, 10, 11, 11,  7, 11,  5, 10, 10, 10, 11, 17,  7, 11,
+  5, 10, 10, 10, 11, 11,  7, 11,  5, 10, 10, 10, 11, 17,  7, 11,
+  5, 10, 10, 18, 11, 11,  7, 11,  5,  5, 10,  4, 11, 17,  7, 11,
+  5, 10, 10,  4, 11, 11,  7, 11,  5,  5, 10,  4, 11, 17,  7, 11,
+]
+def instruction(opcode, fields={}, exclude=[], states=0):
   def bytes_with_wildcards(pattern, wildcard):
     assert 0 <= pattern <= 255
     assert 0 <= wildcard <= 255
@@ -156,6 +343,8 @@ def instruction(opcode, fields={}, exclude=[]):
         field_values = extract_fields(op, fields)
         assert not (op in cpu_opcodes)
         cpu_opcodes[op] = (lambda values: lambda self: func(self, **values))(field_values)
+        cpu_states[op] = states
+        cpu_names[op] = ' '.join([func.__name__[1:]] + ['%s=%d' % item for item in field_values.items()])
   return decorator
 
 FLAGC = 0x01
@@ -203,8 +392,20 @@ def alu_op(op, a, b, carry):
   elif op == 6:
     return (a | b, False, False)
 
+# Snapshots of the architectural state are tuples of these fields, the registers
+# in the order of their codes like s[] in cmodel.c (with the flags in place of
+# M). Taking one is a single attrgetter call and two of them compare in one go,
+# while the instructions keep using plain attributes.
+state_fields = ('rB', 'rC', 'rD', 'rE', 'rH', 'rL', 'rPSR', 'rA', 'rSP', 'rPC', 'int_enabled', 'halted')
+get_state = operator.attrgetter(*state_fields)
+
+def state_diff(a, b):
+  if a == b:
+    return []
+  return [(name, x, y) for (name, x, y) in zip(state_fields, a, b) if x != y]
+
 class CPU:
-  def __init__(self, bus_model):
+  def __init__(self, bus_model, timing=None):
     self.rA = 0
     self.rB = 0
     self.rC = 0
@@ -218,50 +419,79 @@ class CPU:
     self.halted = False
     self.bus_model = bus_model
     self.int_enabled = False
-  async def read(self, addr, io=False):
-    return await self.bus_model.read(addr, io)
+    self.timing = timing
+    self.profiler = None
+    self.clocks = 0
+    self.bus_busy = False
+    self.instructions = 0
+    self.cycles = 0
+    self.bp_addr = [0, 0]
+    self.bp_ctl = 0
+    self.bp_skip = False
+    self.bp_pending = False
+  def bus_cycle(self):
+    self.bus_wait()
+    self.bus_busy = True
+  def bus_done(self, write):
+    if self.timing is not None:
+      self.clocks += self.timing.access(write, self.bus_model.latency) - 1
+  def bus_wait(self):
+    if self.bus_busy and self.timing is not None:
+      self.clocks += self.timing.turnaround
+    self.bus_busy = False
+  def bus_idle(self):
+    self.bus_busy = False
+  def bp_match(self, addr, enable):
+    hit = False
+    for n in range(2):
+      if self.bp_addr[n] == addr & 0xffff and (self.bp_ctl >> 4 * n & enable) != 0:
+        self.bp_ctl |= 8 << 4 * n
+        hit = True
+    return hit
+  async def read(self, addr, io=False, code=False):
+    self.bus_cycle()
+    if not io and not code and self.bp_match(addr, 2):
+      self.bp_pending = True
+    value = await self.bus_model.read(addr, io)
+    self.bus_done(False)
+    return value
   async def write(self, addr, value, io=False):
+    self.bus_cycle()
+    if not io and self.bp_match(addr, 4):
+      self.bp_pending = True
     await self.bus_model.write(addr, value, io)
+    self.bus_done(True)
   async def push(self, value):
     self.rSP = (self.rSP - 1) & 0xffff
-    await self.bus_model.write(self.rSP, value)
+    await self.write(self.rSP, value)
   async def pop(self):
-    data = await self.bus_model.read(self.rSP)
+    data = await self.read(self.rSP)
     self.rSP = (self.rSP + 1) & 0xffff
     return data
+  def snapshot(self):
+    return get_state(self)
+  def restore(self, snapshot):
+    for (name, value) in zip(state_fields, snapshot):
+      setattr(self, name, value)
   def getReg(self, r):
     assert r != 6
-    return [self.rB,self.rC,self.rD,self.rE,self.rH,self.rL,0,self.rA][r]
+    return getattr(self, state_fields[r])
   async def getRegM(self, r):
     if r == 6:
       return await self.read(self.rL | self.rH << 8)
     else:
       return self.getReg(r)
   def setReg(self, r, data):
-    if r == 0:
-      self.rB = data
-    elif r == 1:
-      self.rC = data
-    elif r == 2:
-      self.rD = data
-    elif r == 3:
-      self.rE = data
-    elif r == 4:
-      self.rH = data
-    elif r == 5:
-      self.rL = data
-    elif r == 7:
-      self.rA = data
-    else:
-      assert False
+    assert r != 6
+    setattr(self, state_fields[r], data)
   async def setRegM(self, r, data):
     if r == 6:
       await self.write(self.rL | self.rH << 8, data)
     else:
       self.setReg(r, data)
   async def fetch(self):
-    data = await self.read(self.rPC)
-    self.rPC += 1
+    data = await self.read(self.rPC, code=True)
+    self.rPC = (self.rPC + 1) & 0xffff
     return data
   async def fetch16(self):
     lo = await self.fetch()
@@ -271,16 +501,39 @@ class CPU:
     if self.halted:
       return False
     self.curpc = self.rPC
+    self.bus_wait()
+    clocks = self.clocks
     ir = await self.fetch()
-    #print('PC %.4x IR %.2x AF %.2x%.2x BC %.2x%.2x DE %.2x%.2x HL %.2x%.2x SP %.4x' % (self.curpc, ir, self.rA, self.rPSR, self.rB, self.rC, self.rD, self.rE, self.rH, self.rL, self.rSP))
+    self.fetch_clock = self.bus_model.access_clock
+    self.bus_idle()
+    skip = self.bp_skip
+    self.bp_skip = False
+    if not skip and self.bp_match(self.curpc, 1) or self.bp_pending:
+      self.rPC = self.curpc
+      self.bp_pending = False
+      await self.debug(enter=False)
+      return True
     if not (ir in cpu_opcodes):
       raise Exception("undefined opcode %.2x" % ir)
+    if self.timing is not None:
+      self.timing.check(clocks, self.fetch_clock)
+    self.clocks += 2 + cpu_states[ir]
+    self.instructions += 1
+    self.cycles += i8080_cycles[ir]
+    sp = self.rSP
     await cpu_opcodes[ir](self)
+    if self.profiler is not None:
+      self.profiler.step(self, ir, sp, clocks if self.fetch_clock is None else self.fetch_clock)
     return True
+  # The request is raised while the CPU is halted or during the fetch of the next
+  # instruction, early enough that it is taken right after that instruction.
   async def step_and_interrupt(self, instr):
     assert self.int_enabled
-    await self.bus_model.set_int_req()
-    await self.step()
+    if self.halted:
+      self.bus_model.start_int_req(random.randint(0, 20))
+    else:
+      self.bus_model.int_delay = random.randint(0, 15)
+      await self.step()
     await self.bus_model.int_ack()
     self.int_enabled = False
     self.halted = False
@@ -312,120 +565,121 @@ class CPU:
   @instruction(0x00)
   async def iNOP(self):
     pass
-  @instruction(0x76)
+  @instruction(0x76, states=1)
   async def iHLT(self):
     await self.bus_model.halt()
     self.halted = True
-  @instruction(0x06, {'dst':(5,3)})
+  @instruction(0x06, {'dst':(5,3)}, states=1)
   async def iMVI(self, dst):
     data = await self.fetch()
+    if dst == 6:
+      self.clocks += 1
     await self.setRegM(dst, data)
-  @instruction(0x40, {'dst':(5,3), 'src':(2,0)}, exclude=[0x76])
+  @instruction(0x40, {'dst':(5,3), 'src':(2,0)}, exclude=[0x76], states=1)
   async def iMOV(self, dst, src):
     data = await self.getRegM(src)
     await self.setRegM(dst, data)
-  @instruction(0x80, {'op':(5,3), 'src':(2,0)})
+  @instruction(0x80, {'op':(5,3), 'src':(2,0)}, states=2)
   async def iALU(self, op, src):
     data = await self.getRegM(src)
+    self.bus_idle()
     (result, carry, half_carry) = alu_op(op, self.rA, data, (self.rPSR & FLAGC) != 0)
     if op != 7:
       self.rA = result
     self.flags(result, S='S', Z='Z', P='P', C=carry, H=half_carry)
-  @instruction(0xc6, {'op':(5,3)})
+  @instruction(0xc6, {'op':(5,3)}, states=2)
   async def iALU_d8(self, op):
     data = await self.fetch()
+    self.bus_idle()
     (result, carry, half_carry) = alu_op(op, self.rA, data, (self.rPSR & FLAGC) != 0)
     if op != 7:
       self.rA = result
     self.flags(result, S='S', Z='Z', P='P', C=carry, H=half_carry)
-  @instruction(0xc3)
+  @instruction(0xc3, states=2)
   async def iJMP(self):
-    pcL = await self.read(self.rPC)
-    self.rPC += 1
-    pcH = await self.read(self.rPC)
-    self.rPC = pcL | pcH << 8
-  @instruction(0xc5)
+    self.rPC = await self.fetch16()
+  @instruction(0xc5, states=3)
   async def iPUSH_BC(self):
     await self.push(self.rB)
     await self.push(self.rC)
-  @instruction(0xd5)
+  @instruction(0xd5, states=3)
   async def iPUSH_DE(self):
     await self.push(self.rD)
     await self.push(self.rE)
-  @instruction(0xe5)
+  @instruction(0xe5, states=3)
   async def iPUSH_HL(self):
     await self.push(self.rH)
     await self.push(self.rL)
-  @instruction(0xf5)
+  @instruction(0xf5, states=3)
   async def iPUSH_AF(self):
     await self.push(self.rA)
     await self.push(self.rPSR)
-  @instruction(0xc1)
+  @instruction(0xc1, states=2)
   async def iPOP_BC(self):
     self.rC = await self.pop()
     self.rB = await self.pop()
-  @instruction(0xd1)
+  @instruction(0xd1, states=2)
   async def iPOP_DE(self):
     self.rE = await self.pop()
     self.rD = await self.pop()
-  @instruction(0xe1)
+  @instruction(0xe1, states=2)
   async def iPOP_HL(self):
     self.rL = await self.pop()
     self.rH = await self.pop()
-  @instruction(0xf1)
+  @instruction(0xf1, states=2)
   async def iPOP_AF(self):
     self.rPSR = (await self.pop()) & ~0x28 | 2
     self.rA = await self.pop()
-  @instruction(0x01)
+  @instruction(0x01, states=2)
   async def iLXI_BC(self):
     self.rC = await self.fetch()
     self.rB = await self.fetch()
-  @instruction(0x11)
+  @instruction(0x11, states=2)
   async def iLXI_DE(self):
     self.rE = await self.fetch()
     self.rD = await self.fetch()
-  @instruction(0x21)
+  @instruction(0x21, states=2)
   async def iLXI_HL(self):
     self.rL = await self.fetch()
     self.rH = await self.fetch()
-  @instruction(0x31)
+  @instruction(0x31, states=2)
   async def iLXI_SP(self):
     self.rSP = await self.fetch16()
-  @instruction(0x3a)
+  @instruction(0x3a, states=3)
   async def iLDA(self):
     self.rA = await self.read(await self.fetch16())
-  @instruction(0x32)
+  @instruction(0x32, states=3)
   async def iSTA(self):
     await self.write(await self.fetch16(), self.rA)
-  @instruction(0x2a)
+  @instruction(0x2a, states=4)
   async def iLHLD(self):
     addr = await self.fetch16()
     self.rL = await self.read(addr)
     self.rH = await self.read(addr + 1)
-  @instruction(0x22)
+  @instruction(0x22, states=4)
   async def iSTHD(self):
     addr = await self.fetch16()
     await self.write(addr, self.rL)
     await self.write(addr + 1, self.rH)
-  @instruction(0x07)
+  @instruction(0x07, states=1)
   async def iRLC(self):
     self.flags(0, C=(self.rA & 0x80) != 0)
     self.rA = (self.rA << 1) & 0xff | self.rA >> 7
-  @instruction(0x0f)
+  @instruction(0x0f, states=1)
   async def iRRC(self):
     self.flags(0, C=(self.rA & 1) != 0)
     self.rA = (self.rA >> 1 | self.rA << 7) & 0xff
-  @instruction(0x17)
+  @instruction(0x17, states=1)
   async def iRAL(self):
     c = self.rPSR & 1
     self.flags(0, C=(self.rA & 0x80) != 0)
     self.rA = (self.rA << 1 | c) & 0xff
-  @instruction(0x1f)
+  @instruction(0x1f, states=1)
   async def iRAR(self):
     c = self.rPSR & 1
     self.flags(0, C=(self.rA & 1) != 0)
     self.rA = (self.rA >> 1 | c << 7) & 0xff
-  @instruction(0x27)
+  @instruction(0x27, states=1)
   async def iDAA(self):
     value = 0
     if (self.rA & 0x0f) > 9 or (self.rPSR & FLAGH) != 0:
@@ -435,22 +689,22 @@ class CPU:
     old_carry = (self.rPSR & FLAGC) != 0
     self.rA, carry, half_carry = addition(self.rA, value, False)
     self.flags(self.rA, S='S', Z='Z', P='P', C=(old_carry or carry), H=half_carry)
-  @instruction(0x2f)
+  @instruction(0x2f, states=1)
   async def iCMA(self):
     self.rA ^= 0xff
-  @instruction(0x37)
+  @instruction(0x37, states=1)
   async def iSTC(self):
     self.flags(0, C=True)
-  @instruction(0x3f)
+  @instruction(0x3f, states=1)
   async def iCMC(self):
     self.rPSR ^= FLAGC
-  @instruction(0xcd)
+  @instruction(0xcd, states=4)
   async def iCALL(self):
     target = await self.fetch16()
     await self.push(self.rPC >> 8)
     await self.push(self.rPC & 0xff)
     self.rPC = target
-  @instruction(0xc9)
+  @instruction(0xc9, states=2)
   async def iRET(self):
     lo = await self.pop()
     hi = await self.pop()
@@ -459,147 +713,166 @@ class CPU:
     assert 0 <= cond <= 7
     flag = [FLAGZ, FLAGC, FLAGP, FLAGS][cond>>1]
     return ((self.rPSR & flag) != 0) == ((cond & 1) != 0)
-  @instruction(0xc4, {'cond':(5,3)})
+  @instruction(0xc4, {'cond':(5,3)}, states=4)
   async def iCALLcc(self, cond):
     target = await self.fetch16()
     if self.check_cond(cond):
       await self.push(self.rPC >> 8)
       await self.push(self.rPC & 0xff)
       self.rPC = target
-  @instruction(0xc0, {'cond':(5,3)})
+      self.cycles += 6
+    else:
+      self.clocks -= 2
+  @instruction(0xc0, {'cond':(5,3)}, states=2)
   async def iRETcc(self, cond):
     if self.check_cond(cond):
       lo = await self.pop()
       hi = await self.pop()
       self.rPC = lo | hi << 8
-  @instruction(0xc2, {'cond':(5,3)})
+      self.cycles += 6
+    else:
+      self.clocks -= 2
+  @instruction(0xc2, {'cond':(5,3)}, states=2)
   async def iJMPcc(self, cond):
     target = await self.fetch16()
     if self.check_cond(cond):
       self.rPC = target
-  @instruction(0xc7, {'n':(5,3)})
+  @instruction(0xc7, {'n':(5,3)}, states=4)
   async def iRST(self, n):
     await self.push(self.rPC >> 8)
     await self.push(self.rPC & 0xff)
     self.rPC = n * 8
-  @instruction(0xe9)
+  @instruction(0xe9, states=3)
   async def iPCHL(self):
     self.rPC = self.rL | self.rH << 8
-  @instruction(0xf9)
+  @instruction(0xf9, states=2)
   async def iSPHL(self):
     self.rSP = self.rL | self.rH << 8
-  @instruction(0x04, {'r':(5,3)})
+  @instruction(0x04, {'r':(5,3)}, states=2)
   async def iINR(self, r):
     data = await self.getRegM(r)
     (data, _, half_carry) = addition(data, 1, False)
     await self.setRegM(r, data)
     self.flags(data, S='S', Z='Z', P='P', H=half_carry)
-  @instruction(0x05, {'r':(5,3)})
+  @instruction(0x05, {'r':(5,3)}, states=2)
   async def iDCR(self, r):
     data = await self.getRegM(r)
     (data, _, half_carry) = subtraction(data, 1, False)
     await self.setRegM(r, data)
     self.flags(data, S='S', Z='Z', P='P', H=half_carry)
-  @instruction(0x03)
+  @instruction(0x03, states=2)
   async def iINX_BC(self):
     self.rC = (self.rC + 1) & 0xff
     if self.rC == 0:
       self.rB = (self.rB + 1) & 0xff
-  @instruction(0x13)
+      self.clocks += 2
+  @instruction(0x13, states=2)
   async def iINX_DE(self):
     self.rE = (self.rE + 1) & 0xff
     if self.rE == 0:
       self.rD = (self.rD + 1) & 0xff
-  @instruction(0x23)
+      self.clocks += 2
+  @instruction(0x23, states=2)
   async def iINX_HL(self):
     self.rL = (self.rL + 1) & 0xff
     if self.rL == 0:
       self.rH = (self.rH + 1) & 0xff
-  @instruction(0x33)
+      self.clocks += 2
+  @instruction(0x33, states=1)
   async def iINX_SP(self):
     self.rSP = (self.rSP + 1) & 0xffff
-  @instruction(0x0B)
+  @instruction(0x0B, states=2)
   async def iDCX_BC(self):
     self.rC = (self.rC - 1) & 0xff
     if self.rC == 0xff:
       self.rB = (self.rB - 1) & 0xff
-  @instruction(0x1B)
+      self.clocks += 2
+  @instruction(0x1B, states=2)
   async def iDCX_DE(self):
     self.rE = (self.rE - 1) & 0xff
     if self.rE == 0xff:
       self.rD = (self.rD - 1) & 0xff
-  @instruction(0x2B)
+      self.clocks += 2
+  @instruction(0x2B, states=2)
   async def iDCX_HL(self):
     self.rL = (self.rL - 1) & 0xff
     if self.rL == 0xff:
       self.rH = (self.rH - 1) & 0xff
-  @instruction(0x3B)
+      self.clocks += 2
+  @instruction(0x3B, states=1)
   async def iDCX_SP(self):
     self.rSP = (self.rSP - 1) & 0xffff
-  @instruction(0x09)
+  @instruction(0x09, states=8)
   async def iDAD_BC(self):
     (self.rL, carry, _) = addition(self.rL, self.rC, False)
     (self.rH, carry, _) = addition(self.rH, self.rB, carry)
     self.flags(0, C=carry)
-  @instruction(0x19)
+  @instruction(0x19, states=8)
   async def iDAD_DE(self):
     (self.rL, carry, _) = addition(self.rL, self.rE, False)
     (self.rH, carry, _) = addition(self.rH, self.rD, carry)
     self.flags(0, C=carry)
-  @instruction(0x29)
+  @instruction(0x29, states=8)
   async def iDAD_HL(self):
     (self.rL, carry, _) = addition(self.rL, self.rL, False)
     (self.rH, carry, _) = addition(self.rH, self.rH, carry)
     self.flags(0, C=carry)
-  @instruction(0x39)
+  @instruction(0x39, states=8)
   async def iDAD_SP(self):
     (self.rL, carry, _) = addition(self.rL, self.rSP & 0xff, False)
     (self.rH, carry, _) = addition(self.rH, self.rSP >> 8, carry)
     self.flags(0, C=carry)
-  @instruction(0x0a)
+  @instruction(0x0a, states=3)
   async def iLDAX_BC(self):
     self.rA = await self.read(self.rC | self.rB << 8)
-  @instruction(0x1a)
+  @instruction(0x1a, states=3)
   async def iLDAX_DE(self):
     self.rA = await self.read(self.rE | self.rD << 8)
-  @instruction(0x02)
+  @instruction(0x02, states=3)
   async def iSTAX_BC(self):
     await self.write(self.rC | self.rB << 8, self.rA)
-  @instruction(0x12)
+  @instruction(0x12, states=3)
   async def iSTAX_DE(self):
     await self.write(self.rE | self.rD << 8, self.rA)
-  @instruction(0xEB)
+  @instruction(0xEB, states=6)
   async def iXCHG(self):
     self.rH, self.rD = self.rD, self.rH
     self.rL, self.rE = self.rE, self.rL
-  @instruction(0xE3)
+  @instruction(0xE3, states=6)
   async def iXTHL(self):
     oldVal = self.rL
     self.rL = await self.read(self.rSP)
     await self.write(self.rSP, oldVal)
+    self.bus_idle()
     oldVal = self.rH
     self.rH = await self.read(self.rSP + 1)
     await self.write(self.rSP + 1, oldVal)
-  @instruction(0xfb)
+  @instruction(0xfb, states=1)
   async def iEI(self):
     self.int_enabled = True
-  @instruction(0xf3)
+  @instruction(0xf3, states=1)
   async def iDI(self):
     self.int_enabled = False
-  @instruction(0xdb)
+  @instruction(0xdb, states=2)
   async def iIN(self):
     port = await self.fetch()
     self.rA = await self.read(port, True)
-  @instruction(0xd3)
+  @instruction(0xd3, states=2)
   async def iOUT(self):
     port = await self.fetch()
     await self.write(port, self.rA, True)
-  async def debug(self):
-    await self.bus_model.enter_debug()
+  async def debug(self, enter=True):
+    if enter:
+      await self.bus_model.enter_debug()
+    # the state of the DUT, taking the fields that can't be read from the model
+    regs = [await self.bus_model.debug_read(6 if r == 6 else 8 + r) for r in range(8)]
+    sp = await self.bus_model.debug_read(4) | await self.bus_model.debug_read(5) << 8
+    pc = await self.bus_model.debug_read(16) | await self.bus_model.debug_read(17) << 8
+    expected = self.snapshot()
+    diff = state_diff(expected, tuple(regs) + (sp, pc) + expected[10:])
+    assert diff == [], "mismatch: %s" % ', '.join("%s expected 0x%x, got 0x%x" % d for d in diff)
     mapping = [
-      ('A', 15, self.rA), ('B', 8, self.rB), ('C', 9, self.rC), ('D', 10, self.rD),
-      ('E', 11, self.rE), ('H', 12, self.rH), ('L', 13, self.rL), ('PSR', 6, self.rPSR),
-      ('PC', (17, 16), self.rPC), ('SP', (5,4), self.rSP)
+      ('BP0', (19, 18), self.bp_addr[0]), ('BP1', (21, 20), self.bp_addr[1]), ('BPCTL', 22, self.bp_ctl)
     ]
     for name, addr, expected in mapping:
       if isinstance(addr, tuple):
@@ -609,40 +882,313 @@ class CPU:
         got = lo_value | hi_value << 8
       else:
         got = await self.bus_model.debug_read(addr)
-      if expected != got:
-        raise "mismatch for %s, expected 0x%x, got 0x%x" % (name, expected, got)
+      assert expected == got, "mismatch for %s, expected 0x%x, got 0x%x" % (name, expected, got)
     await self.bus_model.leave_debug()
+    self.bp_skip = True
+  # Puts a snapshot into the DUT through the debug registers, in debug mode, and
+  # into the model. The PC can't be written, so both keep theirs.
+  async def debug_restore(self, snapshot):
+    snapshot = snapshot[:9] + (self.rPC,) + snapshot[10:]
+    for r in range(8):
+      await self.bus_model.debug_write(6 if r == 6 else 8 + r, snapshot[r])
+    await self.bus_model.debug_write(4, snapshot[8] & 0xff)
+    await self.bus_model.debug_write(5, snapshot[8] >> 8)
+    self.restore(snapshot)
+  async def set_breakpoint(self, n, addr, enable):
+    await self.bus_model.enter_debug()
+    self.bp_addr[n] = addr
+    self.bp_ctl = self.bp_ctl & ~(0xf << 4 * n) | enable << 4 * n
+    await self.bus_model.debug_write(18 + 2 * n, addr & 0xff)
+    await self.bus_model.debug_write(19 + 2 * n, addr >> 8)
+    await self.bus_model.debug_write(22, self.bp_ctl)
+    await self.bus_model.leave_debug()
+    self.bp_skip = True
+
+# Reads symbols from a .lst file (lines starting with an address that define a
+# label) or a .sym file (an address and a name per line, in either order).
+def load_symbols(path):
+  symbols = {}
+  with open(path) as file:
+    for line in file:
+      if path.endswith('.lst'):
+        m = re.match(r'\s*([0-9A-Fa-f]{4})\s.*?([A-Za-z_.$?@][\w.$?@]*):', line)
+        if m:
+          symbols[int(m.group(1), 16)] = m.group(2)
+      else:
+        words = [w for w in line.replace(':', ' ').split() if w.upper() not in ('EQU', '=')]
+        addr = [w for w in words if re.match(r'^(0x|\$)?[0-9A-Fa-f]{4}[Hh]?$', w)]
+        names = [w for w in words if not w in addr[:1] and re.match(r'^[A-Za-z_.$?@][\w.$?@]*$', w)]
+        if addr != [] and names != []:
+          symbols[int(re.sub(r'^(0x|\$)|[Hh]$', '', addr[0]), 16)] = names[0]
+  return sorted(symbols.items())
+
+# Counts executions and clocks per PC and opcode and every interval instructions
+# samples the call stack, which is followed through taken CALL, RST and RET.
+# A RET that does not return to a known call site leaves the stack alone, so
+# code that manipulates return addresses only loses frames.
+class Profiler:
+  def __init__(self, interval=1, symbols=None):
+    self.interval = interval
+    self.symbols = load_symbols(symbols) if symbols is not None else []
+    self.addrs = [addr for (addr, name) in self.symbols]
+    self.pc_count = collections.Counter()
+    self.pc_clocks = collections.Counter()
+    self.op_count = collections.Counter()
+    self.op_clocks = collections.Counter()
+    self.stacks = collections.Counter()
+    self.calls = []
+    self.last = None
+    self.n = 0
+  def symbol(self, addr):
+    i = bisect.bisect_right(self.addrs, addr) - 1
+    if i < 0:
+      return ('%.4x' % addr, 0)
+    (start, name) = self.symbols[i]
+    return (name, addr - start)
+  def location(self, addr):
+    (name, offset) = self.symbol(addr)
+    return name if offset == 0 else '%s+0x%x' % (name, offset)
+  def step(self, cpu, ir, sp, clock):
+    if self.last is not None:
+      (pc, op, start) = self.last
+      self.pc_clocks[pc] += clock - start
+      self.op_clocks[op] += clock - start
+    self.last = (cpu.curpc, ir, clock)
+    self.pc_count[cpu.curpc] += 1
+    self.op_count[ir] += 1
+    if (ir == 0xcd or ir & 0xc7 in (0xc4, 0xc7)) and cpu.rSP == (sp - 2) & 0xffff:
+      self.calls = self.calls[-63:] + [(cpu.rPC, (cpu.curpc + (1 if ir & 0xc7 == 0xc7 else 3)) & 0xffff)]
+    elif (ir == 0xc9 or ir & 0xc7 == 0xc0) and cpu.rSP == (sp + 2) & 0xffff:
+      for i in reversed(range(len(self.calls))):
+        if self.calls[i][1] == cpu.rPC:
+          del self.calls[i:]
+          break
+    self.n += 1
+    if self.n % self.interval == 0:
+      frames = ['root'] + [self.symbol(target)[0] for (target, ret) in self.calls]
+      if self.symbols != [] and self.symbol(cpu.rPC)[0] != frames[-1]:
+        frames.append(self.symbol(cpu.rPC)[0])
+      self.stacks[';'.join(frames)] += 1
+  def write_flat(self, file):
+    file.write('%10s %10s  %-4s  %s\n' % ('count', 'clocks', 'pc', 'location'))
+    for pc in sorted(self.pc_count, key=lambda pc: (self.pc_clocks[pc], self.pc_count[pc]), reverse=True):
+      file.write('%10d %10d  %.4x  %s\n' % (self.pc_count[pc], self.pc_clocks[pc], pc, self.location(pc)))
+    file.write('\n%10s %10s  %-4s  %s\n' % ('count', 'clocks', 'op', 'instruction'))
+    for op in sorted(self.op_count, key=lambda op: (self.op_clocks[op], self.op_count[op]), reverse=True):
+      file.write('%10d %10d  %.2x    %s\n' % (self.op_count[op], self.op_clocks[op], op, cpu_names[op]))
+  def write_folded(self, file):
+    for stack, count in sorted(self.stacks.items()):
+      file.write('%s %d\n' % (stack, count))
+
+# With PROFILE=<directory>, a profile of each program is written there as
+# <name>.txt and <name>.folded (for flamegraph.pl). PROFILE_INTERVAL sets the
+# stack sampling interval and PROFILE_SYMBOLS a .sym or .lst file.
+def start_profile(cpu):
+  if 'PROFILE' in os.environ:
+    cpu.profiler = Profiler(int(os.environ.get('PROFILE_INTERVAL', '1')), os.environ.get('PROFILE_SYMBOLS'))
+
+def save_profile(cpu, name):
+  if cpu.profiler is not None:
+    os.makedirs(os.environ['PROFILE'], exist_ok=True)
+    with open(os.path.join(os.environ['PROFILE'], name + '.txt'), 'w') as file:
+      cpu.profiler.write_flat(file)
+    with open(os.path.join(os.environ['PROFILE'], name + '.folded'), 'w') as file:
+      cpu.profiler.write_folded(file)
+
+# With make COVERAGE=yes, tb.v includes coverage.v and the bins it hit are
+# written to coverage/<name>-<seed>.json at the end of each test, along with the
+# clocks it took. For test programs the seed is the program seed, so that
+# cover.py can run them again exactly (test_selected); other tests are run by
+# name. cover.py merges the files and selects the seeds that add coverage.
+test_start = 0
+def save_coverage(dut, name, seed=None, clocks=None):
+  if not hasattr(dut, 'cov'):
+    return
+  result = {
+    'test': name, 'program': seed is not None, 'seed': cocotb.RANDOM_SEED if seed is None else seed,
+    'clocks': round(cocotb.utils.get_sim_time('us') - test_start) if clocks is None else clocks
+  }
+  for group in cover.groups:
+    result[group] = '%x' % int(getattr(dut.cov, group).value)
+  os.makedirs('coverage', exist_ok=True)
+  with open(os.path.join('coverage', '%s-%d.json' % (name, result['seed'])), 'w') as file:
+    json.dump(result, file)
 
 class TestCodeGenerator:
   def __init__(self, memory):
     self.memory = memory
+    # (start, end, address of the code, [(address, length) of the register initializations])
+    # of every test_code(), so test_minimize can take them out again
+    self.snippets = []
   def set_reg(self, r, value):
     assert r >= 0 and r <= 7 and r != 6
     self.memory.append([0x06 | r << 3, value])
   def random_regs(self):
+    inits = [(self.memory.ptr, 5)]
     self.memory.append([0x01, random.randint(0, 255), random.randint(0, 255), 0xc5, 0xf1])
     for i in range(6):
+      inits.append((self.memory.ptr, 2))
       self.set_reg(i, random.randint(0, 255))
+    return inits
   def check_regs(self):
     self.memory.append([0xc5, 0xd5, 0xe5, 0xf5])
   def test_code(self, code, **kwargs):
-    self.random_regs()
+    start = self.memory.ptr
+    inits = self.random_regs()
+    code_addr = self.memory.ptr
     self.memory.append(code)
     if 'jump' in kwargs:
       self.memory.ptr = kwargs['jump']
     if 'after_jump' in kwargs:
       self.memory.append(kwargs['after_jump'])
     self.check_regs()
+    self.snippets.append((start, self.memory.ptr, code_addr, inits))
 
+# (address, length) of the register initializations of a snippet at start
+def snippet_inits(start):
+  return [(start, 5)] + [(start + 5 + 2 * i, 2) for i in range(6)]
+
+# A Memory backed by a NumPy array while a program is generated, so that whole
+# blocks can be written at once. to_memory() turns it into a plain Memory,
+# which is faster for the byte-wise accesses of the simulation.
+class ImageMemory(Memory):
+  def __init__(self, contents):
+    self.contents = contents
+    self.ptr = 0
+    self.dirty = bytearray(256)
+  def read(self, addr):
+    return int(self.contents[addr])
+  def write(self, addr, value):
+    assert value >= 0 and value <= 255
+    self.contents[addr] = value
+    self.dirty[addr >> 8] = 1
+  def mark_dirty(self, addr, end):
+    for page in range(addr >> 8, (end + 255) >> 8):
+      self.dirty[page] = 1
+  def append(self, values):
+    self.contents[self.ptr:self.ptr + len(values)] = values
+    self.mark_dirty(self.ptr, self.ptr + len(values))
+    self.ptr += len(values)
+  def to_memory(self):
+    memory = Memory.__new__(Memory)
+    memory.contents = self.contents.tolist()
+    memory.ptr = self.ptr
+    memory.dirty = bytearray(self.dirty)
+    return memory
+
+# Generates programs with the same snippets as TestCodeGenerator, but the memory
+# image and all register initializations are drawn in bulk with NumPy from the
+# seed; the initializations are written as placeholders and filled in by
+# finish(). random_snippets() lays out a whole block of snippets at once.
+class ImageGenerator(TestCodeGenerator):
+  def __init__(self, seed):
+    self.rng = numpy.random.default_rng(seed)
+    super().__init__(ImageMemory(self.rng.integers(0, 256, 65536, dtype=numpy.uint8)))
+    self.slots = []
+  def random_regs(self):
+    start = self.memory.ptr
+    self.memory.append([0x01, 0, 0, 0xc5, 0xf1, 0x06, 0, 0x0e, 0, 0x16, 0, 0x1e, 0, 0x26, 0, 0x2e, 0])
+    self.slots.append(start)
+    return snippet_inits(start)
+  # Snippets with the given codes, chosen at random, from the current address
+  # up to end. Every snippet leaves the 8 bytes of the register check on the
+  # stack, plus whatever its code pushes and doesn't pop, and the stack grows
+  # down from the top of memory, so the snippets stop before the two would meet.
+  def random_snippets(self, codes, end):
+    lengths = numpy.array([len(code) + 21 for code in codes])
+    depths = numpy.array([8 + 2 * sum((op & 0xcf == 0xc5) - (op & 0xcf == 0xc1) for op in code_opcodes(code)) for code in codes])
+    choice = self.rng.integers(0, len(codes), (end - self.memory.ptr) // lengths.min() + 1)
+    ends = self.memory.ptr + numpy.cumsum(lengths[choice])
+    fits = (ends <= end) & (ends + numpy.cumsum(depths[choice]) <= 0xff00)
+    choice = choice[fits]
+    ends = ends[fits]
+    starts = ends - lengths[choice]
+    for n in numpy.unique(choice):
+      snippet = numpy.array([0x01, 0, 0, 0xc5, 0xf1, 0x06, 0, 0x0e, 0, 0x16, 0, 0x1e, 0, 0x26, 0, 0x2e, 0] + codes[n] + [0xc5, 0xd5, 0xe5, 0xf5], dtype=numpy.uint8)
+      block = numpy.tile(snippet, (numpy.count_nonzero(choice == n), 1))
+      block[:, [1, 2, 6, 8, 10, 12, 14, 16]] = self.rng.integers(0, 256, (len(block), 8))
+      self.memory.contents[starts[choice == n, None] + numpy.arange(len(snippet))] = block
+    for (start, end) in zip(starts.tolist(), ends.tolist()):
+      self.snippets.append((start, end, start + 17, snippet_inits(start)))
+    if len(ends) > 0:
+      self.memory.mark_dirty(self.memory.ptr, int(ends[-1]))
+      self.memory.ptr = int(ends[-1])
+  def finish(self):
+    slots = numpy.array(self.slots, dtype=int)[:, None] + [1, 2, 6, 8, 10, 12, 14, 16]
+    self.memory.contents[slots] = self.rng.integers(0, 256, slots.shape)
+    self.memory = self.memory.to_memory()
+
+def opcode_length(op):
+  if op & 0xcf == 0x01 or op in (0x22, 0x2a, 0x32, 0x3a, 0xc3, 0xcd) or op & 0xc7 in (0xc2, 0xc4):
+    return 3
+  if op & 0xc7 in (0x06, 0xc6) or op in (0xd3, 0xdb):
+    return 2
+  return 1
+
+# The opcodes of straight-line code, without their operands.
+def code_opcodes(code):
+  (ops, n) = ([], 0)
+  while n < len(code):
+    ops.append(code[n])
+    n += opcode_length(code[n])
+  return ops
+
+def timing_program(memory):
+  # RET at address 0 with SP=0 after reset jumps to 0x01c9, this way RST 0 can return like the other RSTs
+  memory.write(0, 0xc9)
+  memory.write(1, 0x01)
+  for n in range(1, 8):
+    memory.write(n * 8, 0xc9)
+  memory.ptr = 0x01c9
+  measured = {}
+  for op in sorted(cpu_opcodes):
+    if op == 0x76:
+      continue
+    length = opcode_length(op)
+    variants = [[]]
+    if op & 0xc7 in (0xc0, 0xc2, 0xc4):
+      variants = [[0x01, psr, 0x00, 0xc5, 0xf1] for psr in (0x02, 0xd7)]
+    if op & 0xc7 == 0x03 and op & 0x30 != 0x30:
+      variants = [[op & 0x30 | 0x01, lo, 0x90] for lo in (0x00, 0xff)]
+    for variant in variants:
+      memory.append([0x31, 0x00, 0x80, 0x21, 0x00, 0x90] + variant)
+      if op == 0xc9 or op & 0xc7 == 0xc0:
+        ret = memory.ptr + 5
+        memory.append([0x01, ret & 0xff, ret >> 8, 0xc5])
+      if op == 0xe9:
+        target = memory.ptr + 4
+        memory.append([0x21, target & 0xff, target >> 8])
+      measured[memory.ptr] = op
+      operand = 0x9000
+      if op in (0xc3, 0xcd) or op & 0xc7 in (0xc2, 0xc4):
+        operand = memory.ptr + 3
+      memory.append([op, operand & 0xff, operand >> 8][:length] if length == 3 else [op, 0x55][:length])
+  return measured
+
+def histogram(values, width=40):
+  counts = collections.Counter(values)
+  peak = max(counts.values())
+  return ['%4d %5d %s' % (v, counts[v], '#' * -(-width * counts[v] // peak)) for v in sorted(counts)]
+
+def log_int_latency(dut, latency):
+  dut._log.info("interrupt latency in clocks: min %d, mean %.1f, max %d" % (min(latency), sum(latency) / len(latency), max(latency)))
+  for line in histogram(latency):
+    dut._log.info(line)
+
+def log_speed(dut, cpu, clocks):
+  clock_mhz = float(os.environ.get('CLOCK_MHZ', '1'))
+  dut._log.info("%d instructions, %d 8080 cycles in %d clocks: %.3f MHz 8080 at %g MHz" % (cpu.instructions, cpu.cycles, clocks, cpu.cycles / clocks * clock_mhz, clock_mhz))
+
+def bus_responder(seed=None):
+  if seed is None:
+    seed = random.getrandbits(32)
+  return responder(os.environ.get('RESPONDER', 'fixed:0'), seed)
 
 async def timeout(dut):
   await Timer(10000, units='ms')
   assert False and "TIMED OUT"
 
-async def setup_dut(dut):
-  clock = Clock(dut.clk, 1, units="us")
-  cocotb.start_soon(clock.start())
-  cocotb.start_soon(timeout(dut))
+async def reset_dut(dut):
   dut.ena.value = 1
   dut.ui_in.value = 0
   dut.uio_in.value = 0
@@ -650,20 +1196,88 @@ async def setup_dut(dut):
   await ClockCycles(dut.clk, 10)
   dut.rst_n.value = 1
 
-def test():
+async def setup_dut(dut):
+  global test_start
+  test_start = cocotb.utils.get_sim_time('us')
+  clock = Clock(dut.clk, 1, units="us")
+  cocotb.start_soon(clock.start())
+  cocotb.start_soon(timeout(dut))
+  await reset_dut(dut)
+
+# The interrupt tests write their programs directly, but like the generated ones
+# they log a seed that everything random about them comes from, including when
+# the interrupts are raised. INT_SEED runs them with a given seed.
+def seed_test(dut, name):
+  seed = int(os.environ['INT_SEED']) if 'INT_SEED' in os.environ else random.getrandbits(32)
+  dut._log.info("%s: seed %d" % (name, seed))
+  random.seed(seed)
+
+# Everything random about a test program, including the I/O data and bus
+# latencies, comes from its seed, which is logged so that a failing program can
+# be run again (and shrunk, see test_minimize in test_multi.py).
+async def generate_program(dut, test_fn, seed):
+  path = image_path(test_fn, seed)
+  if path is not None and os.path.exists(path):
+    return load_image(path)
+  random.seed(seed)
+  codegen = ImageGenerator(seed)
+  await test_fn(dut, codegen)
+  codegen.memory.append([0x76])
+  codegen.finish()
+  if path is not None:
+    save_image(path, codegen)
+  return codegen
+
+# With IMAGE_CACHE=<directory>, generated programs are saved there by test and
+# seed, and by a hash of this file so that changes to the generators don't get
+# old images, and loaded from there instead of generated again.
+def image_path(test_fn, seed):
+  if 'IMAGE_CACHE' not in os.environ:
+    return None
+  with open(__file__, 'rb') as file:
+    digest = hashlib.sha1(file.read()).hexdigest()[:12]
+  return os.path.join(os.environ['IMAGE_CACHE'], '%s-%d-%s.npz' % (test_fn.__name__, seed, digest))
+
+def save_image(path, codegen):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  snippets = numpy.array([snippet[:3] for snippet in codegen.snippets], dtype=int).reshape(-1, 3)
+  numpy.savez(path, image=numpy.array(codegen.memory.contents, dtype=numpy.uint8), snippets=snippets)
+
+def load_image(path):
+  with numpy.load(path) as data:
+    memory = ImageMemory(data['image']).to_memory()
+    codegen = TestCodeGenerator(memory)
+    codegen.snippets = [(start, end, code, snippet_inits(start)) for (start, end, code) in data['snippets'].tolist()]
+  return codegen
+
+async def run_image(dut, memory, seed):
+  cpu = CPU(BusModel(memory, RandomIOModel(seed), dut, bus_responder(seed)), BusTiming(strict=os.environ.get('TIMING') == '1'))
+  start_profile(cpu)
+  while await cpu.step():
+    pass
+  return cpu
+
+async def run_program(dut, test_fn, seed=None):
+  if seed is None:
+    seed = random.getrandbits(32)
+  start = cocotb.utils.get_sim_time('us')
+  dut._log.info("%s: program seed %d" % (test_fn.__name__, seed))
+  codegen = await generate_program(dut, test_fn, seed)
+  cpu = await run_image(dut, codegen.memory, seed)
+  save_profile(cpu, test_fn.__name__)
+  save_coverage(dut, test_fn.__name__, seed, round(cocotb.utils.get_sim_time('us') - start))
+
+test_programs = {}
+def test(skip=False):
   def test_decorator(test_fn):
+    test_programs[test_fn.__name__] = test_fn
+    test_fn.skip = skip
     async def coco_test(dut):
       await setup_dut(dut)
-      memory = Memory()
-      codegen = TestCodeGenerator(memory)
-      await test_fn(dut, codegen)
-      memory.append([0x76])
-      cpu = CPU(BusModel(memory, RandomIOModel(), dut))
-      while await cpu.step():
-        pass
+      await run_program(dut, test_fn)
     coco_test.__name__ = test_fn.__name__
     coco_test.__qualname__ = test_fn.__name__
-    return cocotb.test()(coco_test)
+    return cocotb.test(skip=skip)(coco_test)
   return test_decorator
 
 @test()
@@ -836,6 +1450,57 @@ async def test_IO(dut, codegen):
   codegen.test_code([0xDB, random.randint(0, 255)])
   codegen.test_code([0xD3, random.randint(0, 255)])
 
+# Runs the programs in PROGRAMS (<test>:<seed>,...) with the given seeds, one
+# after the other, e.g. a selection made by cover.py --run.
+@cocotb.test(skip=True)
+async def test_selected(dut):
+  await setup_dut(dut)
+  for program in os.environ['PROGRAMS'].split(','):
+    (name, seed) = program.split(':')
+    await reset_dut(dut)
+    await run_program(dut, test_programs[name], int(seed))
+
+# Runs a program image written by test_minimize, with the seed of the program
+# it came from: make TESTCASE=test_image IMAGE=<file> IMAGE_SEED=<seed>
+@cocotb.test(skip=True)
+async def test_image(dut):
+  await setup_dut(dut)
+  memory = Memory()
+  with open(os.environ['IMAGE'], 'rb') as file:
+    memory.contents = list(file.read())
+  await run_image(dut, memory, int(os.environ.get('IMAGE_SEED', '0')))
+
+# Opcodes that change SP or write to memory other than the stack; in a program
+# that fills the memory they would overwrite the snippets that follow.
+unsafe_opcodes = {0x02, 0x12, 0x22, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x3b, 0xf9} | set(range(0x70, 0x78))
+
+# Codes of the snippets of the other programs that run straight through, without
+# jumps or writes elsewhere in memory, and don't contain unsafe opcodes.
+async def stress_codes(dut):
+  codes = []
+  for test_fn in test_programs.values():
+    if test_fn.skip:
+      continue
+    memory = Memory()
+    memory.clean()
+    codegen = TestCodeGenerator(memory)
+    await test_fn(dut, codegen)
+    starts = [start for (start, end, code, inits) in codegen.snippets]
+    ends = [end for (start, end, code, inits) in codegen.snippets]
+    if starts != [0] + ends[:-1] or any(memory.dirty[(memory.ptr + 255) >> 8:]):
+      continue
+    for (start, end, code, inits) in codegen.snippets:
+      code = memory.contents[code:end - 4]
+      if unsafe_opcodes.isdisjoint(code_opcodes(code)):
+        codes.append(code)
+  return codes
+
+# Fills the memory with random snippets of the other programs (STRESS_SIZE sets
+# the end address).
+@test(skip=True)
+async def test_stress(dut, codegen):
+  codegen.random_snippets(await stress_codes(dut), int(os.environ.get('STRESS_SIZE', '0x10000'), 0))
+
 @cocotb.test()
 async def test_DEBUG(dut):
   await setup_dut(dut)
@@ -847,10 +1512,72 @@ async def test_DEBUG(dut):
   while await cpu.step():
     pass
   await cpu.debug()
+  save_coverage(dut, 'test_DEBUG')
+
+# Runs a program, puts the DUT and the model back to the state and memory from
+# before it and runs it again. The HLT at the end is followed by a jump back to
+# the start, since the PC can't be restored. Both runs have to end the same and
+# only write to 0x8000 and the stack.
+@cocotb.test()
+async def test_RESTORE(dut):
+  await setup_dut(dut)
+  memory = Memory()
+  codegen = TestCodeGenerator(memory)
+  for n in range(8):
+    codegen.test_code([0x32, 0x00, 0x80, 0x3c])
+  memory.append([0x76, 0xc3, 0x00, 0x00])
+  memory.clean()
+  start = memory.copy()
+  cpu = CPU(BusModel(memory, RandomIOModel(), dut))
+  state = cpu.snapshot()
+  while await cpu.step():
+    pass
+  end = (cpu.snapshot(), memory.copy())
+  assert all(addr == 0x8000 or addr >= 0x10000 - 8 * 8 for addr in memory.diff(start))
+  memory = start.copy()
+  cpu.bus_model.memory = memory
+  await cpu.bus_model.enter_debug()
+  await cpu.debug_restore(state)
+  await cpu.debug(enter=False)
+  while await cpu.step():
+    pass
+  assert state_diff(end[0], cpu.snapshot()) == []
+  assert memory.diff(end[1]) == []
+  save_coverage(dut, 'test_RESTORE')
+
+@cocotb.test()
+async def test_BREAK(dut):
+  await setup_dut(dut)
+  memory = Memory()
+  codegen = TestCodeGenerator(memory)
+  for n in range(16):
+    if n == 5:
+      bp_addr = memory.ptr
+    codegen.test_code([0x32, 0x00, 0x80, 0x00, 0x3a, 0x00, 0x80])
+  memory.append([0x76])
+  cpu = CPU(BusModel(memory, RandomIOModel(), dut))
+  await cpu.set_breakpoint(0, bp_addr, 1)
+  await cpu.set_breakpoint(1, 0x8000, 6)
+  while await cpu.step():
+    pass
+  await cpu.debug()
+  # The operands of a JMP are code, so only the LDA's read of them is a data
+  # access that hits the read watchpoints.
+  await reset_dut(dut)
+  memory = Memory()
+  memory.append([0xc3, 0x03, 0x00, 0x3a, 0x01, 0x00, 0x76])
+  cpu = CPU(BusModel(memory, RandomIOModel(), dut))
+  await cpu.set_breakpoint(0, 0x0001, 2)
+  await cpu.set_breakpoint(1, 0x0002, 2)
+  while await cpu.step():
+    pass
+  await cpu.debug()
+  save_coverage(dut, 'test_BREAK')
 
 @cocotb.test()
 async def test_INT(dut):
   await setup_dut(dut)
+  seed_test(dut, 'test_INT')
   memory = Memory()
   codegen = TestCodeGenerator(memory)
   memory.append([0xc3, 0x00, 0x10])
@@ -864,17 +1591,20 @@ async def test_INT(dut):
   cpu = CPU(BusModel(memory, RandomIOModel(), dut))
   next_int = random.randint(10,20)
   while True:
-    if next_int == 0:
+    if next_int <= 0 and memory.read(cpu.rPC) != 0x76:
       await cpu.step_and_interrupt(0xdf)
       next_int = random.randint(10,20)
     else:
       next_int -= 1
       if not await cpu.step():
         break
+  log_int_latency(dut, cpu.bus_model.int_latency)
+  save_coverage(dut, 'test_INT')
 
 @cocotb.test()
 async def test_INT_HALT(dut):
   await setup_dut(dut)
+  seed_test(dut, 'test_INT_HALT')
   memory = Memory()
   codegen = TestCodeGenerator(memory)
   memory.append([0xc3, 0x00, 0x10])
@@ -885,11 +1615,51 @@ async def test_INT_HALT(dut):
   for i in range(10):
     memory.append([0x76])
   cpu = CPU(BusModel(memory, RandomIOModel(), dut))
-  while await cpu.step():
-    pass
-  await cpu.step_and_interrupt(0xdf)
   for i in range(10):
+    while await cpu.step():
+      pass
+    await cpu.step_and_interrupt(0xdf)
+  log_int_latency(dut, cpu.bus_model.int_latency)
+  save_coverage(dut, 'test_INT_HALT')
+
+# Measures the clocks of every opcode (for conditional instructions and INX/DCX
+# both paths) and compares them against timing_<simulator>.txt, since the
+# handshakes with the bench can take different clocks on different simulators.
+# Run with TIMING_UPDATE=1 to write the new numbers after an intended change,
+# or to record them for a simulator that has no table yet.
+@cocotb.test()
+async def test_timing(dut):
+  await setup_dut(dut)
+  memory = Memory()
+  measured = timing_program(memory)
+  memory.append([0x76])
+  cpu = CPU(BusModel(memory, RandomIOModel(), dut), BusTiming())
+  clocks = {}
+  last = None
+  while not cpu.halted:
+    pc = cpu.rPC
     await cpu.step()
+    if last is not None:
+      (op, clock) = last
+      clocks.setdefault(op, []).append(cpu.fetch_clock - clock)
+    last = (measured[pc], cpu.fetch_clock) if pc in measured else None
+  save_coverage(dut, 'test_timing')
+  table = ['%.2x %d %d\n' % (op, min(c), max(c)) for op, c in sorted(clocks.items())]
+  path = 'timing_%s.txt' % cocotb.SIM_NAME.split()[0].lower()
+  if os.environ.get('TIMING_UPDATE') == '1':
+    with open(path, 'w') as file:
+      file.writelines(table)
+    return
+  if not os.path.exists(path):
+    dut._log.warning("no %s to compare with, record it with TIMING_UPDATE=1" % path)
+    return
+  with open(path) as file:
+    baseline = file.readlines()
+  if baseline != table:
+    print(''.join(difflib.unified_diff(baseline, table, path, 'measured')))
+  expected = {int(op, 16): (int(lo), int(hi)) for (op, lo, hi) in (line.split() for line in baseline)}
+  slower = ['%.2x' % op for op, c in clocks.items() if not op in expected or min(c) > expected[op][0] or max(c) > expected[op][1]]
+  assert slower == [], "instructions got slower: %s" % ' '.join(slower)
 
 class MSBasicIOModel:
   def __init__(self):
@@ -920,20 +1690,32 @@ async def test_msbasic(dut):
     basic = list(file.read())
   for i in range(len(basic)):
     memory.write(i, basic[i])
-  cpu = CPU(BusModel(memory, MSBasicIOModel(), dut))
+  cpu = CPU(BusModel(memory, MSBasicIOModel(), dut, bus_responder()), BusTiming(strict=os.environ.get('TIMING') == '1'))
+  start_profile(cpu)
+  start = cpu.bus_model.clock()
   while cpu.rPC != 0x1f8:
     await cpu.step()
+  log_speed(dut, cpu, cpu.bus_model.clock() - start)
+  save_profile(cpu, 'msbasic')
+  save_coverage(dut, 'test_msbasic')
 
+# Runs the model without the DUT, with the latency the responder would add to
+# each access for BusTiming.
 class DummyBusModel:
-  def __init__(self, memory, io_model):
+  access_clock = None
+  def __init__(self, memory, io_model, responder):
     self.memory = memory
     self.io_model = io_model
+    self.responder = responder
+    self.latency = 0
   async def read(self, addr, io=False):
+    self.latency = sum(self.responder.latency(state, addr, io) for state in (0, 1, 2))
     if io:
       return self.io_model.io_in(addr)
     else:
       return self.memory.read(addr)
   async def write(self, addr, value, io=False):
+    self.latency = sum(self.responder.latency(state, addr, io) for state in (0, 1, 3))
     if io:
       return self.io_model.io_out(addr, value)
     else:
@@ -971,12 +1753,16 @@ async def test_exerciser(dut):
   memory.write(6, 0xcc)
   memory.write(7, 0xc9)
   io_model = CPMIOModel()
-  cpu = CPU(DummyBusModel(memory, io_model))
+  cpu = CPU(DummyBusModel(memory, io_model, bus_responder()), BusTiming())
   io_model.cpu = cpu
   cpu.rPC = 0x100
+  start_profile(cpu)
   n = 0
   while cpu.rPC != 0x00:
     await cpu.step()
     n += 1
     if (n % 1000000) == 0:
-      print(('%10d' % n) + '\b' * 9, end='', flush=True)
\ No newline at end of file
+      print(('%10d' % n) + '\b' * 9, end='', flush=True)
+  print()
+  log_speed(dut, cpu, cpu.clocks)
+  save_profile(cpu, 'exerciser')
\ No newline at end of file
@@ -0,0 +1,152 @@
+# SPDX-FileCopyrightText: © 2024 Tiny Tapeout
+# SPDX-License-Identifier: MIT
+
+import cocotb
+from cocotb.clock import Clock
+from cocotb.triggers import with_timeout
+from cocotb.result import SimTimeoutError
+from cocotb.utils import get_sim_time
+import os
+import re
+import traceback
+import test
+
+# One core of tb_multi.v for the functions in test.py. Its clock edges are taken
+# from the top level: with Verilator, waiting for the clk port of a core makes
+# every handshake one clock shorter than in tb.v and the timing checks fail.
+class Core:
+  def __init__(self, dut, n):
+    self.handle = dut.core[n].core_i
+    self.clk = dut.clk
+  def __getattr__(self, name):
+    return getattr(self.handle, name)
+
+# Runs all @test() programs from test.py on the cores of tb_multi.v, each core
+# taking the next program from the queue as soon as it is done with the last one.
+@cocotb.test()
+async def test_multi(dut):
+  clock = Clock(dut.clk, 1, units="us")
+  cocotb.start_soon(clock.start())
+  cocotb.start_soon(test.timeout(dut))
+  queue = [(name, test_fn) for (name, test_fn) in test.test_programs.items() if not test_fn.skip]
+  async def worker(n, core):
+    while queue:
+      name, test_fn = queue.pop(0)
+      dut._log.info("core %d: %s" % (n, name))
+      await test.reset_dut(core)
+      await test.run_program(core, test_fn)
+  workers = [cocotb.start_soon(worker(n, Core(dut, n))) for n in range(int(dut.CORES.value))]
+  for w in workers:
+    await w
+
+# Puts a program back together from the parts of a TestCodeGenerator program
+# that are kept: a snippet that is left out is jumped over, a register
+# initialization that is left out is replaced by NOPs.
+def reduced_image(codegen, snippets, inits):
+  (snippets, inits) = (set(snippets), set(inits))
+  memory = codegen.memory.copy()
+  for n, (start, end, code, regs) in enumerate(codegen.snippets):
+    if n not in snippets:
+      memory.ptr = start
+      memory.append([0xc3, end & 0xff, end >> 8])
+      continue
+    for i, (addr, length) in enumerate(regs):
+      if (n, i) not in inits:
+        memory.ptr = addr
+        memory.append([0x00] * length)
+  return memory
+
+def write_listing(file, codegen, snippets, inits):
+  inits = set(inits)
+  for n in sorted(snippets):
+    (start, end, code, regs) = codegen.snippets[n]
+    op = codegen.memory.read(code)
+    kept = ['flags' if i == 0 else 'BCDEHLMA'[i - 1] for i in range(len(regs)) if (n, i) in inits]
+    file.write('%4d %.4x  %.2x  %-20s init %s\n' % (n, code, op, test.cpu_names.get(op, '?'), ' '.join(kept) or '-'))
+
+# Delta debugging: looks for a smaller subset of elements that still fails,
+# first among the n parts of elements, then among their complements, and
+# splits finer if neither fails. All candidates of a round run in parallel.
+async def ddmin(dut, elements, fails):
+  n = 2
+  while len(elements) >= 2:
+    size = len(elements) / n
+    parts = [elements[round(i * size):round((i + 1) * size)] for i in range(n)]
+    candidates = parts + ([[e for e in elements if not e in part] for part in parts] if n > 2 else [])
+    dut._log.info("%d elements, %d candidates" % (len(elements), len(candidates)))
+    results = await fails(candidates)
+    if True in results[:n]:
+      elements = parts[results.index(True)]
+      n = 2
+    elif True in results:
+      elements = candidates[results.index(True)]
+      n = max(n - 1, 2)
+    elif n < len(elements):
+      n = min(2 * n, len(elements))
+    else:
+      break
+  return elements
+
+# A candidate fails the same way if it raises the same exception at the same
+# place with the same message, apart from the numbers in it, which change with
+# the program (clocks, register values). Anything else doesn't count.
+def failure_of(e):
+  (filename, line, function, text) = traceback.extract_tb(e.__traceback__)[-1]
+  return '%s at %s:%d: %s' % (type(e).__name__, os.path.basename(filename), line, re.sub(r'0x[0-9a-fA-F]+|\d+', 'N', str(e)))
+
+# Shrinks a failing test program: make minimize MINIMIZE=<test>:<seed>, with the
+# seed that run_program logged. The program is generated again from the seed and
+# snippets and then register initializations are taken out as long as the
+# result fails the same way, trying the candidates on all cores at once. The
+# smallest program is written to minimized/<test>-<seed>.bin, together with a
+# listing of what is left in it.
+@cocotb.test(skip=True)
+async def test_minimize(dut):
+  clock = Clock(dut.clk, 1, units="us")
+  cocotb.start_soon(clock.start())
+  (name, seed) = os.environ['MINIMIZE'].split(':')
+  seed = int(seed)
+  codegen = await test.generate_program(dut, test.test_programs[name], seed)
+  cores = [Core(dut, n) for n in range(int(dut.CORES.value))]
+  limit = 10000000
+  async def run(core, memory):
+    await test.reset_dut(core)
+    try:
+      await with_timeout(test.run_image(core, memory, seed), limit, 'us')
+    except SimTimeoutError:
+      return 'timeout'
+    except Exception as e:
+      return failure_of(e)
+    return None
+  async def results(images):
+    queue = list(enumerate(images))
+    result = [None] * len(images)
+    async def worker(core):
+      while queue:
+        (n, memory) = queue.pop(0)
+        result[n] = await run(core, memory)
+    workers = [cocotb.start_soon(worker(core)) for core in cores]
+    for w in workers:
+      await w
+    return result
+  start = get_sim_time('us')
+  failure = await run(cores[0], codegen.memory.copy())
+  assert failure is not None, "%s does not fail with seed %d" % (name, seed)
+  dut._log.info("%s with seed %d: %s after %d us" % (name, seed, failure, get_sim_time('us') - start))
+  limit = 2 * (get_sim_time('us') - start) + 1000
+  snippets = list(range(len(codegen.snippets)))
+  everything = [(n, i) for n in snippets for i in range(len(codegen.snippets[n][3]))]
+  async def snippets_fail(candidates):
+    return [r == failure for r in await results([reduced_image(codegen, c, everything) for c in candidates])]
+  snippets = await ddmin(dut, snippets, snippets_fail)
+  inits = [(n, i) for (n, i) in everything if n in snippets]
+  async def inits_fail(candidates):
+    return [r == failure for r in await results([reduced_image(codegen, snippets, c) for c in candidates])]
+  inits = await ddmin(dut, inits, inits_fail)
+  dut._log.info("%d of %d snippets and %d of %d register initializations left" % (len(snippets), len(codegen.snippets), len(inits), len(everything)))
+  path = os.path.join('minimized', '%s-%d' % (name, seed))
+  os.makedirs('minimized', exist_ok=True)
+  with open(path + '.bin', 'wb') as file:
+    file.write(bytes(reduced_image(codegen, snippets, inits).contents))
+  with open(path + '.txt', 'w') as file:
+    write_listing(file, codegen, snippets, inits)